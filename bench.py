@@ -0,0 +1,214 @@
+from __future__ import print_function
+
+import argparse
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+
+from deterministic import compare_traces
+from envs import create_synthetic_env
+from model import ActorCritic
+from optim import SharedAdam
+from train import run_update
+
+# Usage:
+#   python bench.py bf16 --updates 200
+#   python bench.py compare-trace golden.jsonl trace.jsonl
+#   python bench.py imports train test
+#   python bench.py lstm --batch-sizes 1 16 256
+#
+# Traces come from deterministic runs, e.g.
+#   python main.py golden --synthetic-env --deterministic --no-visdom --trace-path golden.jsonl
+
+parser = argparse.ArgumentParser(description='A3C benchmarks')
+subparsers = parser.add_subparsers(dest='command')
+
+bf16_parser = subparsers.add_parser('bf16', help='bfloat16 vs fp32 convergence parity and throughput')
+bf16_parser.add_argument('--updates', type=int, default=200,
+                         help='updates per precision mode (default: 200)')
+bf16_parser.add_argument('--lr', type=float, default=0.001,
+                         help='learning rate of both runs (default: 0.001)')
+bf16_parser.add_argument('--gamma', type=float, default=0.5,
+                         help='discount factor of both runs; the synthetic cues are independent, so a low '
+                              'discount learns them in a few hundred updates (default: 0.5)')
+bf16_parser.add_argument('--min-improvement', type=float, default=10.,
+                         help='rollout reward fp32 must gain for the comparison to count (default: 10)')
+bf16_parser.add_argument('--tolerance', type=float, default=0.1,
+                         help='allowed relative gap in final reward (default: 0.1)')
+bf16_parser.add_argument('--seed', type=int, default=666, help='random seed (default: 666)')
+
+compare_parser = subparsers.add_parser('compare-trace', help='check a deterministic run against a golden trace')
+compare_parser.add_argument('golden', help='trace of the reference run')
+compare_parser.add_argument('trace', help='trace of the run to check')
+
+imports_parser = subparsers.add_parser('imports', help='import time profile of worker modules')
+imports_parser.add_argument('modules', nargs='*', default=['train', 'test', 'pbt'],
+                            help='modules to import (default: train test pbt)')
+imports_parser.add_argument('--top', type=int, default=10,
+                            help='number of slowest imports to list (default: 10)')
+
+lstm_parser = subparsers.add_parser('lstm', help='stock vs fused recurrent core latency on CPU')
+lstm_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32, 64, 128, 256],
+                         help='batch sizes to time (default: 1 to 256 in powers of two)')
+lstm_parser.add_argument('--steps', type=int, default=200,
+                         help='recurrent steps per timing at batch size 1, scaled down for larger '
+                              'batches (default: 200)')
+lstm_parser.add_argument('--repeats', type=int, default=5,
+                         help='timings per batch size and core, the fastest is reported (default: 5)')
+lstm_parser.add_argument('--tolerance', type=float, default=1e-5,
+                         help='allowed absolute difference between the cores (default: 1e-5)')
+lstm_parser.add_argument('--seed', type=int, default=666, help='random seed (default: 666)')
+
+
+def train_args(**kwargs):
+    # Mirrors the defaults of main.py for the options used by run_update
+    args = argparse.Namespace(lr=0.0001 * 2.5, gamma=0.99, tau=1.00, entropy_coef=0.0005,
+                              value_loss_coef=0.5, conv_depth_loss_coef=10, lstm_depth_loss_coef=10,
+                              max_grad_norm=50, seed=666, num_steps=50, bf16=False, loss_scale=1.)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def train_synthetic(args, updates):
+    """Trains a single worker on the synthetic env.
+
+    Returns the rollout rewards of every update and the wall time spent in
+    updates.
+    """
+    torch.manual_seed(args.seed)
+    env = create_synthetic_env()
+    env.seed(args.seed)
+
+    shared_model = ActorCritic(env.observation_space.spaces[0].shape[0], env.action_space)
+    model = ActorCritic(env.observation_space.spaces[0].shape[0], env.action_space)
+    optimizer = SharedAdam(shared_model.parameters(), lr=args.lr)
+    optimizer.share_memory()
+
+    rewards = []
+    elapsed = 0.
+    state = env.reset()
+    for _ in range(updates):
+        start = time.time()
+        state, _, rollout_rewards, _ = run_update(args, model, shared_model, optimizer, env, state)
+        elapsed += time.time() - start
+        rewards.append(sum(rollout_rewards))
+
+    return np.array(rewards), elapsed
+
+
+def bench_bf16(options):
+    torch.set_num_threads(1)
+    window = max(options.updates // 5, 1)
+
+    results = {}
+    for name, bf16 in (('fp32', False), ('bf16', True)):
+        args = train_args(seed=options.seed, bf16=bf16, lr=options.lr, gamma=options.gamma)
+        rewards, elapsed = train_synthetic(args, options.updates)
+        results[name] = rewards[-window:].mean()
+        print('{}: first {} updates {:.2f}, last {} updates {:.2f}, {:.1f} updates/s'.format(
+            name, window, rewards[:window].mean(), window, rewards[-window:].mean(), options.updates / elapsed))
+
+        if not bf16:
+            # Matching an untrained baseline says nothing about convergence
+            improvement = rewards[-window:].mean() - rewards[:window].mean()
+            if improvement < options.min_improvement:
+                print('fp32 improved by {:.2f} < {}, the task was not learned; raise --updates or --lr'.format(
+                    improvement, options.min_improvement))
+                return 1
+
+    gap = abs(results['bf16'] - results['fp32']) / max(abs(results['fp32']), 1.)
+    print('relative final reward gap {:.3f} (tolerance {})'.format(gap, options.tolerance))
+    return 0 if gap <= options.tolerance else 1
+
+
+def bench_compare_trace(options):
+    mismatch = compare_traces(options.golden, options.trace)
+    if mismatch is None:
+        print('traces match')
+        return 0
+
+    print('first mismatch:\n  golden {}\n  trace  {}'.format(*mismatch))
+    return 1
+
+
+def bench_imports(options):
+    # -X importtime writes "self [us] | cumulative | name" lines to stderr
+    stmt = '; '.join('import {}'.format(module) for module in options.modules)
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', stmt],
+                            stderr=subprocess.PIPE, universal_newlines=True, check=True).stderr
+
+    imports = []
+    for line in output.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[0].startswith('import time:') and fields[1].strip().isdigit():
+            imports.append((int(fields[1]), int(fields[0].split(':')[1]), fields[2].rstrip()))
+
+    total = sum(self_us for _, self_us, _ in imports)
+    print('importing {} takes {:.3f}s'.format(', '.join(options.modules), total / 1e6))
+    print('{:>12} {:>12}  module'.format('cumulative', 'self'))
+    for cumulative, self_us, name in sorted(imports, reverse=True)[:options.top]:
+        print('{:>11.3f}s {:>11.3f}s {}'.format(cumulative / 1e6, self_us / 1e6, name))
+    return 0
+
+
+def time_core(model, inputs, steps):
+    # Feeds the hidden state back in, as the workers do
+    features, reward, velocity, action, hidden = inputs
+    start = time.perf_counter()
+    for _ in range(steps):
+        hidden = model.core(features, reward, velocity, action, hidden)
+    return time.perf_counter() - start
+
+
+def bench_lstm(options):
+    torch.set_num_threads(1)
+    torch.manual_seed(options.seed)
+    env = create_synthetic_env()
+    model = ActorCritic(env.observation_space.spaces[0].shape[0], env.action_space)
+    model.eval()
+
+    print('{:>6} {:>14} {:>14} {:>8} {:>10}'.format('batch', 'stock (us)', 'fused (us)', 'speedup', 'max diff'))
+    max_diff = 0.
+    with torch.no_grad():
+        for batch_size in options.batch_sizes:
+            inputs = (torch.randn(batch_size, 256), torch.randn(batch_size, 1),
+                      torch.randn(batch_size, 3), torch.randn(batch_size, 3),
+                      ((torch.randn(batch_size, 64), torch.randn(batch_size, 64)),
+                       (torch.randn(batch_size, 256), torch.randn(batch_size, 256))))
+
+            outputs = []
+            for fused in (False, True):
+                model.fused_core = fused
+                outputs.append(model.core(*inputs))
+            diff = max(float((stock - fused).abs().max())
+                       for stock_state, fused_state in zip(*outputs)
+                       for stock, fused in zip(stock_state, fused_state))
+            max_diff = max(max_diff, diff)
+
+            steps = max(options.steps // batch_size, 10)
+            timings = {False: [], True: []}
+            # Interleaved, so both cores see the same machine load
+            for _ in range(options.repeats):
+                for fused in (False, True):
+                    model.fused_core = fused
+                    timings[fused].append(time_core(model, inputs, steps) / steps)
+            stock, fused = min(timings[False]), min(timings[True])
+            print('{:>6} {:>14.1f} {:>14.1f} {:>7.2f}x {:>10.2e}'.format(
+                batch_size, stock * 1e6, fused * 1e6, stock / fused, diff))
+
+    print('max difference {:.2e} (tolerance {})'.format(max_diff, options.tolerance))
+    return 0 if max_diff <= options.tolerance else 1
+
+
+if __name__ == '__main__':
+    options = parser.parse_args()
+    commands = {'bf16': bench_bf16, 'compare-trace': bench_compare_trace, 'imports': bench_imports,
+                'lstm': bench_lstm}
+    if options.command not in commands:
+        parser.print_help()
+        sys.exit(2)
+    sys.exit(commands[options.command](options))
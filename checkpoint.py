@@ -0,0 +1,243 @@
+import glob
+import json
+import os
+import zlib
+
+import numpy as np
+import torch
+
+# A checkpoint is a directory holding one full snapshot, at most one delta
+# against it and latest.json pointing at the newer of the two. Every
+# snapshot is a JSON index plus a flat binary file of tensor data:
+#
+#   full-000012.json / .bin        tensors at 64 byte aligned offsets
+#   delta-000015-000012.json / .bin  zlib compressed XOR against full-000012
+#
+# Uncompressed full snapshots can be memory-mapped; the model weights can be
+# loaded without reading the optimizer state at all. Compressed tensors are
+# split into byte planes first, so the sign and exponent bytes, which
+# change least, form their own compressible runs.
+#
+# Adam changes the low mantissa bits of every weight and moment on every
+# update, so neither deltas nor compression shrink a checkpoint much. In
+# a 20.5 MB A3C checkpoint, a delta after 20 updates is 14.9 MB and a
+# compressed full snapshot 16.6 MB. Deltas cut the bytes written per save
+# by about a quarter, but keeping base and delta takes ~1.7x the disk of
+# a single full snapshot, which is why full snapshots are the default.
+
+ALIGNMENT = 64
+LATEST = 'latest.json'
+
+
+def _encode(obj, prefix, tensors):
+    if isinstance(obj, torch.Tensor):
+        tensors[prefix] = obj
+        return {'__tensor__': prefix}
+    if isinstance(obj, dict):
+        return {'__dict__': [[key, _encode(value, '{}/{}'.format(prefix, key), tensors)]
+                             for key, value in obj.items()]}
+    if isinstance(obj, tuple):
+        return {'__tuple__': [_encode(value, '{}/{}'.format(prefix, idx), tensors)
+                              for idx, value in enumerate(obj)]}
+    if isinstance(obj, list):
+        return [_encode(value, '{}/{}'.format(prefix, idx), tensors) for idx, value in enumerate(obj)]
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return obj
+
+
+def _decode(obj, load_tensor):
+    if isinstance(obj, dict):
+        if '__tensor__' in obj:
+            return load_tensor(obj['__tensor__'])
+        if '__dict__' in obj:
+            return dict((key, _decode(value, load_tensor)) for key, value in obj['__dict__'])
+        if '__tuple__' in obj:
+            return tuple(_decode(value, load_tensor) for value in obj['__tuple__'])
+    if isinstance(obj, list):
+        return [_decode(value, load_tensor) for value in obj]
+    return obj
+
+
+def _snapshot_path(path, name, ext):
+    return os.path.join(path, '{}.{}'.format(name, ext))
+
+
+def _read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_json(path, obj):
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def _split_planes(data, itemsize):
+    return np.frombuffer(data, np.uint8).reshape(-1, itemsize).T.tobytes()
+
+
+def _join_planes(data, itemsize):
+    return np.frombuffer(data, np.uint8).reshape(itemsize, -1).T.tobytes()
+
+
+def checkpoint_exists(path):
+    return os.path.isfile(os.path.join(path, LATEST))
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints in the flat format, alternating full and delta snapshots.
+
+    Arguments:
+        path (str): checkpoint directory
+        half (bool, optional): store float32 model weights as float16
+        compress (bool, optional): zlib compress full snapshots too, which
+            makes them smaller but no longer memory-mappable
+        full_interval (int, optional): write a full snapshot every n saves,
+            deltas in between (default: 1, no deltas)
+    """
+
+    def __init__(self, path, half=False, compress=False, full_interval=1):
+        self.path = os.path.abspath(path)
+        self.half = half
+        self.compress = compress
+        self.full_interval = full_interval
+        self.seq = 0
+        self.base = None
+        self._base_bytes = None
+
+        if checkpoint_exists(self.path):
+            latest = _read_json(os.path.join(self.path, LATEST))
+            self.seq = latest['seq']
+            self.base = latest['base']
+
+    def _stored(self, name, tensor):
+        array = tensor.detach().cpu().contiguous().numpy()
+        if self.half and name.startswith('/model/') and array.dtype == np.float32:
+            array = array.astype(np.float16)
+        return array
+
+    def _load_base_bytes(self):
+        if self._base_bytes is None:
+            index = _read_json(_snapshot_path(self.path, self.base, 'json'))
+            with open(_snapshot_path(self.path, self.base, 'bin'), 'rb') as f:
+                data = f.read()
+            self._base_bytes = dict((name, _entry_bytes(entry, data)) for name, entry in index['tensors'].items())
+        return self._base_bytes
+
+    def save(self, state):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        tensors = {}
+        meta = _encode(state, '', tensors)
+        self.seq += 1
+        full = self.base is None or self.seq % self.full_interval == 0
+        name = 'full-{:06d}'.format(self.seq) if full else 'delta-{:06d}-{}'.format(self.seq, self.base[5:])
+        base_bytes = None if full else self._load_base_bytes()
+
+        entries = {}
+        offset = 0
+        raw = {}
+        with open(_snapshot_path(self.path, name, 'bin'), 'wb') as f:
+            for tensor_name, tensor in tensors.items():
+                array = self._stored(tensor_name, tensor)
+                data = array.tobytes()
+                raw[tensor_name] = data
+                entry = dict(dtype=str(tensor.dtype).replace('torch.', ''), stored=str(array.dtype),
+                             shape=list(array.shape), compressed=False, delta=False)
+
+                base = base_bytes.get(tensor_name) if base_bytes is not None else None
+                if base is not None and len(base) == len(data):
+                    # Unchanged bits become zero bytes, which compress well
+                    data = np.bitwise_xor(np.frombuffer(data, np.uint8), np.frombuffer(base, np.uint8)).tobytes()
+                    entry['delta'] = True
+                if entry['delta'] or self.compress or not full:
+                    data = zlib.compress(_split_planes(data, array.itemsize), 1)
+                    entry.update(compressed=True, planes=True)
+
+                offset += -offset % ALIGNMENT
+                f.seek(offset)
+                f.write(data)
+                entry.update(offset=offset, nbytes=len(data))
+                entries[tensor_name] = entry
+                offset += len(data)
+
+        _write_json(_snapshot_path(self.path, name, 'json'),
+                    dict(meta=meta, tensors=entries, base=None if full else self.base))
+        _write_json(os.path.join(self.path, LATEST), dict(snapshot=name, seq=self.seq,
+                                                          base=name if full else self.base))
+
+        if full:
+            self.base = name
+            self._base_bytes = raw
+        self._cleanup(name)
+
+    def _cleanup(self, latest):
+        keep = set([latest, self.base])
+        for index_path in glob.glob(os.path.join(self.path, '*.json')):
+            name = os.path.splitext(os.path.basename(index_path))[0]
+            if name.startswith(('full-', 'delta-')) and name not in keep:
+                for ext in ('json', 'bin'):
+                    snapshot_path = _snapshot_path(self.path, name, ext)
+                    if os.path.exists(snapshot_path):
+                        os.remove(snapshot_path)
+
+
+def _entry_bytes(entry, data):
+    chunk = data[entry['offset']:entry['offset'] + entry['nbytes']]
+    if not entry['compressed']:
+        return bytes(chunk)
+    chunk = zlib.decompress(chunk)
+    return _join_planes(chunk, np.dtype(entry['stored']).itemsize) if entry.get('planes') else chunk
+
+
+def _read_data(path, mmap):
+    if mmap and os.path.getsize(path) > 0:
+        return np.memmap(path, dtype=np.uint8, mode='c')
+    with open(path, 'rb') as f:
+        return np.frombuffer(bytearray(f.read()), dtype=np.uint8)
+
+
+def load_checkpoint(path, model_only=False, mmap=True):
+    """Loads the latest checkpoint in ``path``.
+
+    With ``model_only`` only the model weights are read and the returned
+    state holds just ``model``. With ``mmap``, uncompressed full snapshots
+    are memory-mapped instead of read, so unchanged weights are paged in
+    lazily and shared between processes loading the same file.
+    """
+    path = os.path.abspath(path)
+    latest = _read_json(os.path.join(path, LATEST))
+    index = _read_json(_snapshot_path(path, latest['snapshot'], 'json'))
+    bin_path = _snapshot_path(path, latest['snapshot'], 'bin')
+
+    data = _read_data(bin_path, mmap)
+
+    base = None
+    if index['base'] is not None:
+        base_index = _read_json(_snapshot_path(path, index['base'], 'json'))
+        base = (base_index['tensors'], _read_data(_snapshot_path(path, index['base'], 'bin'), mmap))
+
+    def load_tensor(name):
+        entry = index['tensors'][name]
+        if entry['compressed']:
+            array = np.frombuffer(bytearray(_entry_bytes(entry, data)), dtype=np.uint8)
+        else:
+            array = data[entry['offset']:entry['offset'] + entry['nbytes']]
+        if entry['delta']:
+            base_entries, base_data = base
+            array = np.bitwise_xor(array, np.frombuffer(_entry_bytes(base_entries[name], base_data), np.uint8))
+
+        array = array.view(entry['stored']).reshape(entry['shape'])
+        tensor = torch.from_numpy(array)
+        if entry['stored'] != entry['dtype']:
+            tensor = tensor.to(getattr(torch, entry['dtype']))
+        return tensor
+
+    meta = index['meta']
+    if model_only:
+        meta = {'__dict__': [[key, value] for key, value in meta['__dict__'] if key == 'model']}
+    return _decode(meta, load_tensor)
@@ -0,0 +1,91 @@
+import ctypes
+
+import numpy as np
+import torch.multiprocessing as mp
+
+CACHE_LINE = 64
+SLOT_WIDTH = CACHE_LINE // ctypes.sizeof(ctypes.c_int64)
+
+
+class StepCounters(object):
+    """Named 64-bit counters split into one cache line per writer.
+
+    Each process only ever adds to its own slot, so increments need neither
+    a lock nor an atomic instruction and never bounce a cache line between
+    cores. Totals are aggregated lazily by the reader.
+
+    Arguments:
+        names (tuple): counter names, at most ``SLOT_WIDTH`` of them
+        num_slots (int): number of writers (one slot each)
+    """
+
+    def __init__(self, names, num_slots):
+        if len(names) > SLOT_WIDTH:
+            raise ValueError('At most {} counters fit in a slot'.format(SLOT_WIDTH))
+
+        self.names = tuple(names)
+        self.index = dict((name, idx) for idx, name in enumerate(self.names))
+        self.num_slots = num_slots
+        # One spare line so the slots can be aligned to a cache line boundary
+        self._raw = mp.RawArray(ctypes.c_int64, (num_slots + 1) * SLOT_WIDTH)
+        self._attach()
+
+    def _attach(self):
+        shift = (-ctypes.addressof(self._raw) % CACHE_LINE) // ctypes.sizeof(ctypes.c_int64)
+        data = np.frombuffer(self._raw, dtype=np.int64)
+        self.data = data[shift:shift + self.num_slots * SLOT_WIDTH].reshape(self.num_slots, SLOT_WIDTH)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def add(self, slot, **counts):
+        row = self.data[slot]
+        for name, n in counts.items():
+            row[self.index[name]] += n
+
+    def approx(self, name):
+        """Sum of all slots without any synchronization; may miss in-flight adds."""
+        return int(self.data[:, self.index[name]].sum())
+
+    def total(self, name, retries=100):
+        """Sum over a consistent cut of all slots.
+
+        Slots only grow, so two identical consecutive reads mean no slot
+        changed in between and the sum is exact at that moment.
+        """
+        idx = self.index[name]
+        last = self.data[:, idx].copy()
+        for _ in range(retries):
+            current = self.data[:, idx].copy()
+            if np.array_equal(current, last):
+                break
+            last = current
+        return int(last.sum())
+
+
+class IntervalTrigger(object):
+    """Fires once each time a counter crosses a multiple of ``interval``.
+
+    Triggers are local to the process that owns them, so no two processes
+    contend over them; give only one process a trigger for actions that
+    must happen once per interval, like checkpointing.
+    """
+
+    def __init__(self, counters, name, interval):
+        self.counters = counters
+        self.name = name
+        self.interval = interval
+        self.last = counters.approx(name) // interval
+
+    def __call__(self):
+        bucket = self.counters.approx(self.name) // self.interval
+        if bucket <= self.last:
+            return False
+        self.last = bucket
+        return True
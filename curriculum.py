@@ -0,0 +1,89 @@
+import ctypes
+
+import numpy as np
+import torch.multiprocessing as mp
+
+# Per map statistics
+FAST, SLOW, COUNT, LAST_SEEN = range(4)
+NUM_FIELDS = 4
+
+
+class MapScheduler(object):
+    """Samples training maps in proportion to how much the agent is learning on them.
+
+    Learning progress is the gap between a fast and a slow moving average
+    of a map's episode return. Maps are ranked by it, as in Prioritized
+    Level Replay (Jiang et al., 2021), and the rank based distribution is
+    mixed with a staleness distribution that favours maps not played for
+    many episodes and with a uniform one. Unplayed maps rank first.
+
+    The statistics live in shared memory and are updated by all training
+    workers without locking; a lost update only delays a map's estimate.
+
+    Arguments:
+        maps (list): map names
+        staleness (float, optional): weight of the staleness distribution
+        exploration (float, optional): weight of the uniform distribution
+        temperature (float, optional): sharpness of the rank distribution,
+            lower favours the top ranked maps more
+        fast (float, optional): update rate of the fast return average
+        slow (float, optional): update rate of the slow return average
+    """
+
+    def __init__(self, maps, staleness=0.1, exploration=0.05, temperature=0.1, fast=0.3, slow=0.05):
+        self.maps = list(maps)
+        self.index = dict((name, idx) for idx, name in enumerate(self.maps))
+        self.staleness = staleness
+        self.exploration = exploration
+        self.temperature = temperature
+        self.fast = fast
+        self.slow = slow
+
+        self._raw = mp.RawArray(ctypes.c_double, len(self.maps) * NUM_FIELDS + 1)
+        self._attach()
+
+    def _attach(self):
+        data = np.frombuffer(self._raw, dtype=np.float64)
+        self.stats = data[:-1].reshape(len(self.maps), NUM_FIELDS)
+        self.episodes = data[-1:]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['stats'], state['episodes']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def update(self, name, episode_return):
+        row = self.stats[self.index[name]]
+        if row[COUNT] == 0:
+            row[FAST] = row[SLOW] = episode_return
+        else:
+            row[FAST] += self.fast * (episode_return - row[FAST])
+            row[SLOW] += self.slow * (episode_return - row[SLOW])
+        row[COUNT] += 1
+        self.episodes[0] += 1
+        row[LAST_SEEN] = self.episodes[0]
+
+    def probabilities(self):
+        stats = self.stats.copy()
+        progress = np.abs(stats[:, FAST] - stats[:, SLOW])
+        progress[stats[:, COUNT] == 0] = np.inf
+
+        ranks = np.empty(len(self.maps))
+        ranks[np.argsort(-progress, kind='stable')] = np.arange(1, len(self.maps) + 1)
+        scores = (1. / ranks) ** (1. / self.temperature)
+        scores /= scores.sum()
+
+        stale = self.episodes[0] - stats[:, LAST_SEEN]
+        stale = stale / stale.sum() if stale.sum() > 0 else np.full(len(self.maps), 1. / len(self.maps))
+
+        uniform = np.full(len(self.maps), 1. / len(self.maps))
+        probs = ((1 - self.staleness - self.exploration) * scores +
+                 self.staleness * stale + self.exploration * uniform)
+        return probs / probs.sum()
+
+    def sample(self, rng):
+        return self.maps[rng.choice(len(self.maps), p=self.probabilities())]
@@ -0,0 +1,65 @@
+import hashlib
+import json
+from contextlib import contextmanager
+
+import numpy as np
+import torch.multiprocessing as mp
+
+
+class TokenScheduler(object):
+    """Serializes worker updates in a fixed round-robin order.
+
+    A single token is passed from rank to rank; a worker may only sync,
+    roll out and step the optimizer while it holds the token, so Hogwild
+    updates are applied in the same order on every run.
+    """
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self._turn = mp.Value('i', 0, lock=False)
+        self._cond = mp.Condition()
+
+    @contextmanager
+    def turn(self, rank, kill=None):
+        with self._cond:
+            while self._turn.value != rank:
+                self._cond.wait(1.)
+                if kill is not None and kill.is_set():
+                    raise RuntimeError('worker {} stopped waiting for its turn'.format(rank))
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._turn.value = (rank + 1) % self.num_workers
+                self._cond.notify_all()
+
+
+def digest(values):
+    return hashlib.sha1(np.ascontiguousarray(values).tobytes()).hexdigest()[:16]
+
+
+def trace_record(update, rank, actions, loss):
+    return dict(update=update, rank=rank, steps=len(actions),
+                actions=digest(np.array(actions, dtype=np.int64)),
+                loss=digest(np.array([loss], dtype=np.float32)))
+
+
+def append_trace(path, record):
+    with open(path, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def compare_traces(golden_path, trace_path):
+    """Returns None if both traces match, else the first differing pair of records."""
+    with open(golden_path) as golden, open(trace_path) as trace:
+        golden_records = [json.loads(line) for line in golden]
+        trace_records = [json.loads(line) for line in trace]
+
+    for expected, actual in zip(golden_records, trace_records):
+        if expected != actual:
+            return expected, actual
+    if len(golden_records) != len(trace_records):
+        longer = golden_records if len(golden_records) > len(trace_records) else trace_records
+        extra = longer[min(len(golden_records), len(trace_records))]
+        return (extra, None) if longer is golden_records else (None, extra)
+    return None
@@ -1,34 +1,64 @@
-import cv2
+import os
+import re
+from collections import namedtuple
+from functools import lru_cache
+
 import gym
 import torch
 import numpy as np
-import vizdoom
-import matplotlib.pyplot as plt
-from omg import WAD, MapEditor
-from PIL import Image, ImageDraw
+
+from lazy import lazy_import
+
+# Only the processes that run the engine, render or parse WADs pay for these
+cv2 = lazy_import('cv2')
+vizdoom = lazy_import('vizdoom')
+omg = lazy_import('omg')
+
+
+def preload_modules():
+    """Imports the lazy engine modules, which is safe to do before forking workers."""
+    return cv2.resize, vizdoom.DoomGame, omg.WAD
+
+
+def build_spaces(num_buttons):
+    observation_space = gym.spaces.Tuple((gym.spaces.Box(0, 1, (3, 82, 82), dtype=np.float32),
+                                          gym.spaces.Box(0, 1, (8, 4 * 16), dtype=np.float32),
+                                          gym.spaces.Box(-1, 1, (0,), dtype=np.float32),
+                                          gym.spaces.Discrete(num_buttons),
+                                          gym.spaces.Box(-1, 1, (3,), dtype=np.float32)))
+    return observation_space, gym.spaces.Discrete(num_buttons)
+
+
+def config_buttons(config):
+    """Reads the available buttons from a ViZDoom config without starting the engine."""
+    with open(config) as f:
+        text = re.sub(r'#.*', '', f.read())
+
+    buttons = []
+    for op, value in re.findall(r'^\s*available_buttons\s*(\+?=)\s*\{([^}]*)\}', text, re.MULTILINE | re.IGNORECASE):
+        if op == '=':
+            buttons = []
+        buttons += value.split()
+    return buttons
 
 
 class ViZDoomEnv(gym.Env):
     metadata = {'render.modes': ['human', 'rgb_array', 'rgbd_array']}
 
-    def __init__(self, config, scenario):
+    def __init__(self, config, scenario, map_scheduler=None):
         game = vizdoom.DoomGame()
         game.load_config(config)
         game.set_doom_scenario_path(scenario)
         game.init()
         self.game = game
         self.scenario = scenario
-        self.wad = WAD(scenario)
+        self.maps = sorted(load_map_geometry(scenario).keys())
+        self.map_scheduler = map_scheduler
 
         num_buttons = len(game.get_available_buttons())
-        self.action_space = gym.spaces.Discrete(num_buttons)
+        self.observation_space, self.action_space = build_spaces(num_buttons)
         self.action_map = tuple([action_idx == button_idx for button_idx in range(num_buttons)]
                                 for action_idx in range(num_buttons))
-        self.observation_space = gym.spaces.Tuple((gym.spaces.Box(0, 1, (3, 82, 82), dtype=np.float32),
-                                                   gym.spaces.Box(0, 1, (8, 4 * 16), dtype=np.float32),
-                                                   gym.spaces.Box(-1, 1, (0,), dtype=np.float32),
-                                                   gym.spaces.Discrete(num_buttons),
-                                                   gym.spaces.Box(-1, 1, (3,), dtype=np.float32)))
         self.current_map = None
         self.episode_reward = 0.0
         self.step_counter = 0
@@ -103,6 +133,8 @@ class ViZDoomEnv(gym.Env):
     def seed(self, seed=None):
         if seed is not None:
             self.game.set_seed(seed)
+        # Map selection uses its own generator so it is reproducible per env
+        self.np_random = np.random.RandomState(seed)
         return [seed]
 
     def step(self, action, steps=1):
@@ -114,7 +146,12 @@ class ViZDoomEnv(gym.Env):
         return state, reward, done, {}
 
     def reset(self):
-        next_map = np.random.choice(self.wad.maps.keys())
+        if self.map_scheduler is None:
+            next_map = self.np_random.choice(self.maps)
+        else:
+            if self.current_map is not None and self.step_counter > 0:
+                self.map_scheduler.update(self.current_map, self.episode_reward)
+            next_map = self.map_scheduler.sample(self.np_random)
         self.current_map = next_map
         self.game.set_doom_map(next_map)
         self.game.new_episode()
@@ -122,8 +159,13 @@ class ViZDoomEnv(gym.Env):
         self.step_counter = 0
         return self._state()
 
+    def close(self):
+        self.game.close()
+
     def render(self, mode='rgb_array'):
         if mode == 'human':
+            import matplotlib.pyplot as plt
+
             plt.figure(1)
             plt.clf()
             plt.imshow(self.render(mode='rgb_array'))
@@ -139,24 +181,227 @@ class ViZDoomEnv(gym.Env):
         assert False, 'Unsupported render mode'
 
 
-def create_vizdoom_env(config, scenario):
-    env = ViZDoomEnv(config, scenario)
+class SyntheticEnv(gym.Env):
+    """Engine-free stand-in for ViZDoomEnv with identical spaces.
+
+    Every step shows a cue: one screen channel is lit and the matching
+    action earns a reward of 1, any other action the living reward. The
+    depth target is a fixed random pattern per episode. Rewards do not
+    depend on earlier actions, so with a low discount the cue is learned
+    within a few hundred updates. Runs are fully determined by the seed,
+    which makes the env suitable for parity and throughput checks of the
+    training loop.
+    """
+    metadata = {'render.modes': ['rgb_array']}
+
+    def __init__(self, num_buttons=3, episode_length=300, living_reward=-0.01):
+        self.scenario = None
+        self.maps = ['SYNTHETIC']
+        self.current_map = None
+        self.num_buttons = num_buttons
+        self.episode_length = episode_length
+        self.living_reward = living_reward
+
+        self.observation_space, self.action_space = build_spaces(num_buttons)
+        self.episode_reward = 0.0
+        self.step_counter = 0
+        self.seed()
+
+    def seed(self, seed=None):
+        self.np_random = np.random.RandomState(seed)
+        return [seed]
+
+    def pose(self):
+        return 0., 0., 0., 0.
+
+    def goal(self):
+        return 0., 0., 0.
+
+    def _state(self, last_reward, last_action):
+        self.cue = self.np_random.randint(self.num_buttons)
+        screen_buffer = self.np_random.uniform(0., 0.1, (3, 82, 82)).astype(np.float32)
+        screen_buffer[self.cue % 3] += 0.9
+
+        action = np.zeros(self.num_buttons, dtype=np.float32)
+        if last_action is not None:
+            action[last_action] = 1.
+
+        return (screen_buffer, self.depth.copy(), np.array([last_reward], dtype=np.float32),
+                action, np.zeros(3, dtype=np.float32))
+
+    def step(self, action, steps=1):
+        action = int(np.asarray(action).reshape(-1)[0])
+        reward = 1.0 if action == self.cue else self.living_reward * steps
+        self.episode_reward += reward
+        self.step_counter += 1
+        done = self.step_counter >= self.episode_length
+        return self._state(reward, action), reward, done, {}
+
+    def reset(self):
+        self.current_map = self.maps[0]
+        self.depth = np.eye(8, dtype=np.float32)[self.np_random.randint(8, size=64)].reshape(-1)
+        self.episode_reward = 0.0
+        self.step_counter = 0
+        return self._state(0., None)
+
+    def render(self, mode='rgb_array'):
+        return self._state(0., None)
+
+
+def create_vizdoom_env(config, scenario, map_scheduler=None):
+    env = ViZDoomEnv(config, scenario, map_scheduler)
     return env
 
 
+def create_synthetic_env():
+    return SyntheticEnv()
+
+
+def env_spaces(args):
+    """Returns the observation and action spaces of the env ``create_env`` builds."""
+    if getattr(args, 'synthetic_env', False):
+        env = create_synthetic_env()
+        return env.observation_space, env.action_space
+    return build_spaces(len(config_buttons(args.config_path)))
+
+
+def create_env(args, scenario, map_scheduler=None):
+    if getattr(args, 'synthetic_env', False):
+        return create_synthetic_env()
+    return create_vizdoom_env(args.config_path, scenario, map_scheduler)
+
+
 def state_to_torch(state):
     return tuple(torch.from_numpy(t).unsqueeze(0) for t in state)
 
 
-def drawmap(wad, name, height):
-    edit = MapEditor(wad.maps[name])
-    xmin = ymin = 32767
-    xmax = ymax = -32768
-    for v in edit.vertexes:
-        xmin = min(xmin, v.x)
-        xmax = max(xmax, v.x)
-        ymin = min(ymin, -v.y)
-        ymax = max(ymax, -v.y)
+MapGeometry = namedtuple('MapGeometry', ['vertexes', 'lines', 'two_sided', 'action', 'bounds'])
+
+MAP_CACHE_SIZE = 32
+
+_map_geometry = {}
+
+
+def map_geometry_bytes():
+    return sum(value.nbytes for geometry in _map_geometry.values()
+               for geom in geometry.values() for value in geom)
+
+
+def geometry_path(scenario):
+    return os.path.splitext(os.path.abspath(scenario))[0] + '.geometry.npz'
+
+
+def _parse_map_geometry(scenario):
+    geometry = {}
+    wad = omg.WAD(scenario)
+    for name in wad.maps.keys():
+        edit = omg.MapEditor(wad.maps[name])
+        vertexes = np.array([(v.x, -v.y) for v in edit.vertexes], dtype=np.float32).reshape(-1, 2)
+        lines = np.array([(l.vx_a, l.vx_b) for l in edit.linedefs], dtype=np.int32).reshape(-1, 2)
+        two_sided = np.array([bool(l.two_sided) for l in edit.linedefs], dtype=bool)
+        action = np.array([bool(l.action) for l in edit.linedefs], dtype=bool)
+        bounds = np.concatenate((vertexes.min(axis=0), vertexes.max(axis=0)))
+        geometry[name] = MapGeometry(vertexes, lines, two_sided, action, bounds)
+    return geometry
+
+
+def _load_geometry_file(path):
+    with np.load(path) as data:
+        data = dict(data)
+
+    geometry = {}
+    vertex_splits = np.split(data['vertexes'], data['vertex_offsets'])
+    line_splits = [np.split(data[field], data['line_offsets'])
+                   for field in ('lines', 'two_sided', 'action')]
+    for idx, name in enumerate(data['names']):
+        geometry[str(name)] = MapGeometry(vertex_splits[idx], line_splits[0][idx], line_splits[1][idx],
+                                          line_splits[2][idx], data['bounds'][idx])
+    return geometry
+
+
+def _save_geometry_file(path, geometry):
+    names = sorted(geometry.keys())
+    maps = [geometry[name] for name in names]
+    arrays = dict(names=np.array(names),
+                  vertexes=np.concatenate([m.vertexes for m in maps]),
+                  vertex_offsets=np.cumsum([len(m.vertexes) for m in maps])[:-1],
+                  lines=np.concatenate([m.lines for m in maps]),
+                  two_sided=np.concatenate([m.two_sided for m in maps]),
+                  action=np.concatenate([m.action for m in maps]),
+                  line_offsets=np.cumsum([len(m.lines) for m in maps])[:-1],
+                  bounds=np.stack([m.bounds for m in maps]))
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, path)
+    except OSError:
+        # Read-only scenario directories simply don't get a persistent cache
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def load_map_geometry(scenario):
+    """Returns a dict of map name to MapGeometry for the WAD at ``scenario``.
+
+    The WAD is parsed at most once per process; the extracted arrays are also
+    persisted next to the WAD and reused while newer than it.
+    """
+    scenario = os.path.abspath(scenario)
+    if scenario in _map_geometry:
+        return _map_geometry[scenario]
+
+    path = geometry_path(scenario)
+    if os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(scenario):
+        geometry = _load_geometry_file(path)
+    else:
+        geometry = _parse_map_geometry(scenario)
+        _save_geometry_file(path, geometry)
+
+    _map_geometry[scenario] = geometry
+    return geometry
+
+
+# Offsets of the five strokes drawn for every linedef, giving 3px wide lines
+_BRUSH = np.array([(0, 0), (1, 0), (-1, 0), (0, 1), (0, -1)], dtype=np.float64)
+
+
+def _bresenham(starts, ends):
+    """Pixels of the integer lines from ``starts`` to ``ends``, both included.
+
+    Reproduces the Bresenham variant of PIL's ``ImageDraw.line``. Returns
+    the pixels and, for each, the index of the line it belongs to.
+    """
+    deltas = ends - starts
+    steps = np.where(deltas < 0, -1, 1)
+    deltas = np.abs(deltas)
+    lengths = deltas.max(axis=1) + 1
+
+    line_idx = np.repeat(np.arange(len(starts)), lengths)
+    i = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    major = deltas.argmax(axis=1)
+    # PIL steps along y when both deltas are equal
+    major[deltas[:, 0] == deltas[:, 1]] = 1
+    minor = 1 - major
+    rows = np.arange(len(starts))
+    d_major = deltas[rows, major][line_idx]
+    d_minor = deltas[rows, minor][line_idx]
+
+    offsets = np.empty((len(i), 2), dtype=np.int64)
+    offsets[np.arange(len(i)), major[line_idx]] = i
+    # The error term of Bresenham's loop in closed form
+    offsets[np.arange(len(i)), minor[line_idx]] = (2 * d_minor * i + d_major) // np.maximum(2 * d_major, 1)
+    return starts[line_idx] + steps[line_idx] * offsets, line_idx
+
+
+@lru_cache(maxsize=MAP_CACHE_SIZE)
+def _rasterize(scenario, name, height):
+    vertexes, lines, two_sided, action, bounds = load_map_geometry(scenario)[name]
+    # Vertex coordinates are integers; scaling them in float64 keeps the
+    # pixel positions of the original float drawing
+    xmin, ymin, xmax, ymax = bounds.astype(np.float64)
 
     scale = height / float(ymax - ymin)
     xmax = int(xmax * scale)
@@ -164,47 +409,50 @@ def drawmap(wad, name, height):
     ymax = int(ymax * scale)
     ymin = int(ymin * scale)
 
-    for v in edit.vertexes:
-        v.x = v.x * scale
-        v.y = -v.y * scale
+    im = np.full((ymax - ymin, xmax - xmin, 3), 255, dtype=np.uint8)
+
+    # One-sided walls are drawn last so they stay on top of two-sided lines
+    order = np.argsort(~two_sided, kind='stable')
+    colors = np.zeros((len(lines), 3), dtype=np.uint8)
+    colors[two_sided] = (144, 144, 144)
+    colors[action] = (220, 130, 50)
+    colors = colors[order]
 
-    im = Image.new('RGB', (xmax - xmin, ymax - ymin), (255, 255, 255))
-    draw = ImageDraw.Draw(im)
-    edit.linedefs.sort(key=lambda a: not a.two_sided)
+    points = vertexes.astype(np.float64) * scale - np.array([xmin, ymin], dtype=np.float64)
+    p1 = points[lines[order, 0]]
+    p2 = points[lines[order, 1]]
 
-    for line in edit.linedefs:
-        p1x = edit.vertexes[line.vx_a].x - xmin
-        p1y = edit.vertexes[line.vx_a].y - ymin
-        p2x = edit.vertexes[line.vx_b].x - xmin
-        p2y = edit.vertexes[line.vx_b].y - ymin
+    # Every stroke of a line, in drawing order; PIL truncates the float
+    # end points towards zero
+    starts = np.trunc(p1[:, None, :] + _BRUSH[None, :, :]).astype(np.int64).reshape(-1, 2)
+    ends = np.trunc(p2[:, None, :] + _BRUSH[None, :, :]).astype(np.int64).reshape(-1, 2)
+    pixels, stroke_idx = _bresenham(starts, ends)
+    line_idx = stroke_idx // len(_BRUSH)
 
-        color = (0, 0, 0)
-        if line.two_sided:
-            color = (144, 144, 144)
-        if line.action:
-            color = (220, 130, 50)
+    valid = ((pixels[:, 0] >= 0) & (pixels[:, 0] < im.shape[1]) &
+             (pixels[:, 1] >= 0) & (pixels[:, 1] < im.shape[0]))
+    im[pixels[valid, 1], pixels[valid, 0]] = colors[line_idx[valid]]
+    im.setflags(write=False)
 
-        draw.line((p1x, p1y, p2x, p2y), fill=color)
-        draw.line((p1x + 1, p1y, p2x + 1, p2y), fill=color)
-        draw.line((p1x - 1, p1y, p2x - 1, p2y), fill=color)
-        draw.line((p1x, p1y + 1, p2x, p2y + 1), fill=color)
-        draw.line((p1x, p1y - 1, p2x, p2y - 1), fill=color)
+    return im, xmin, ymin, scale
 
-    del draw
 
-    return np.array(im), xmin, ymin, scale
+def drawmap(scenario, name, height):
+    im, xmin, ymin, scale = _rasterize(os.path.abspath(scenario), name, height)
+    return im.copy(), xmin, ymin, scale
 
 
 frames = None
 
 
-def trajectory_to_video(wad, name, height, history, goal):
+def trajectory_to_video(scenario, name, height, history, goal):
     global frames
 
-    empty_map, xmin, ymin, scale = drawmap(wad, name, height)
+    empty_map, xmin, ymin, scale = drawmap(scenario, name, height)
     cv2.circle(empty_map, (int(goal[0] * scale) - xmin, int(- goal[1] * scale) - ymin), 2, (255, 0, 0), -1)
 
-    if frames is None:
+    # The buffer is reused across episodes and only grows
+    if frames is None or len(frames) < len(history) or frames.shape[1:] != empty_map.shape:
         frames = np.zeros([len(history)] + list(empty_map.shape), dtype=np.uint8)
 
     last_img = empty_map
@@ -223,4 +471,4 @@ def trajectory_to_video(wad, name, height, history, goal):
         cv2.line(dir_frame, point, shift, (0, 0, 255), 2)
         frames[idx, :, :, :] = dir_frame
 
-    return frames
+    return frames[:len(history)]
@@ -0,0 +1,32 @@
+import importlib
+import importlib.util
+import sys
+
+
+class _MissingModule(object):
+    def __init__(self, name):
+        self.__name__ = name
+
+    def __getattr__(self, attr):
+        raise ImportError('{} is required for this feature but is not installed'.format(self.__name__))
+
+
+def lazy_import(name):
+    """Returns ``name`` as a module that is only executed on first attribute access.
+
+    Heavy optional dependencies imported this way cost nothing in processes
+    that never use them. Missing modules only raise once they are used.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return _MissingModule(name)
+
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
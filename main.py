@@ -1,21 +1,26 @@
 from __future__ import print_function
 
 import argparse
+import gc
 import os
 import numpy as np
-import skvideo.io
 
 import torch
 import torch.multiprocessing as mp
 from torch.optim import Adam
 
-from visdom import Visdom
-
-from envs import create_vizdoom_env
+from checkpoint import CheckpointWriter, checkpoint_exists, load_checkpoint
+from counters import StepCounters
+from curriculum import MapScheduler
+from deterministic import TokenScheduler
+from envs import env_spaces, load_map_geometry, preload_modules
+from metrics import MetricsStore, collect
 from model import ActorCritic
 from test import test
 from train import train
 from optim import SharedAdam
+import pbt
+import vtrace
 
 # Based on
 # https://github.com/pytorch/examples/tree/master/mnist_hogwild
@@ -54,6 +59,52 @@ parser.add_argument('--train-scenario-path', default='./doomfiles/11.wad',
                     help='ViZDoom scenario path for training (default: ./doomfiles/11.wad)')
 parser.add_argument('--test-scenario-path', default='./doomfiles/11.wad',
                     help='ViZDoom scenario path for testing (default: ./doomfiles/11.wad)')
+parser.add_argument('--synthetic-env', action='store_true', default=False,
+                    help='train on the engine-free synthetic env instead of ViZDoom')
+parser.add_argument('--bf16', action='store_true', default=False,
+                    help='run forward/backward passes in bfloat16 autocast on CPU')
+parser.add_argument('--loss-scale', type=float, default=1.,
+                    help='static loss scale applied in the backward pass (default: 1)')
+parser.add_argument('--population-size', type=int, default=1,
+                    help='train this many members with population based training (default: 1, off)')
+parser.add_argument('--pbt-interval', type=float, default=600,
+                    help='seconds between PBT exploit/explore steps (default: 600)')
+parser.add_argument('--pbt-fraction', type=float, default=0.25,
+                    help='fraction of members replaced per PBT step (default: 0.25)')
+parser.add_argument('--pbt-ready', type=int, default=20,
+                    help='updates a member needs before it takes part in PBT (default: 20)')
+parser.add_argument('--memory-report-interval', type=int, default=0,
+                    help='report per-worker memory every n episodes (default: 0, off)')
+parser.add_argument('--lean-workers', action='store_true', default=False,
+                    help='load read-only map data once and share it copy-on-write with the workers')
+parser.add_argument('--max-video-frames', type=int, default=1500,
+                    help='most recent frames buffered for the evaluation video (default: 1500)')
+parser.add_argument('--deterministic', action='store_true', default=False,
+                    help='apply worker updates in a fixed round-robin order for reproducible runs')
+parser.add_argument('--trace-path', help='JSONL file to append per-update action and loss hashes to')
+parser.add_argument('--map-priority', action='store_true', default=False,
+                    help='sample training maps by learning progress instead of uniformly')
+parser.add_argument('--map-staleness', type=float, default=0.1,
+                    help='weight of maps not played for a while in map sampling (default: 0.1)')
+parser.add_argument('--map-exploration', type=float, default=0.05,
+                    help='weight of uniform map sampling (default: 0.05)')
+parser.add_argument('--map-temperature', type=float, default=0.1,
+                    help='temperature of the learning progress ranking (default: 0.1)')
+parser.add_argument('--fused-core', action='store_true', default=False,
+                    help='run the LSTM core of evaluation and V-trace actor workers on split, '
+                         'input-major weights (see bench.py lstm)')
+parser.add_argument('--vtrace', action='store_true', default=False,
+                    help='decouple acting from learning: actors feed rollouts to a single V-trace learner')
+parser.add_argument('--vtrace-rho-bar', type=float, default=1.,
+                    help='clip of the V-trace importance weights in the value targets (default: 1)')
+parser.add_argument('--vtrace-c-bar', type=float, default=1.,
+                    help='clip of the V-trace trace cutting coefficients (default: 1)')
+parser.add_argument('--actor-sync-interval', type=int, default=10,
+                    help='rollouts between policy syncs of a V-trace actor (default: 10)')
+parser.add_argument('--rollout-queue-size', type=int, default=16,
+                    help='rollouts V-trace actors may run ahead of the learner (default: 16)')
+parser.add_argument('--learner-batch-size', type=int, default=8,
+                    help='most rollouts the V-trace learner batches into one update (default: 8)')
 parser.add_argument('--no-shared', default=False,
                     help='use an optimizer without shared momentum.')
 parser.add_argument('--save-interval', type=int, default=20,
@@ -61,24 +112,89 @@ parser.add_argument('--save-interval', type=int, default=20,
 parser.add_argument('--eval-interval', type=int, default=60,
                     help='run evaluation every n seconds (default: 60)')
 parser.add_argument('--checkpoint-path', help='file path to save models')
+parser.add_argument('--checkpoint-format', choices=['flat', 'torch'],
+                    help='flat: memory-mappable snapshot directory, torch: single torch.save file '
+                         '(default: torch if --checkpoint-path is an existing file, else flat)')
+parser.add_argument('--checkpoint-half', action='store_true', default=False,
+                    help='store model weights as float16 in flat checkpoints')
+parser.add_argument('--checkpoint-compress', action='store_true', default=False,
+                    help='zlib compress full flat snapshots, which then can no longer be memory-mapped')
+parser.add_argument('--checkpoint-full-interval', type=int, default=1,
+                    help='write a full flat snapshot every n saves, deltas in between; deltas write about a '
+                         'quarter fewer bytes per save but keep two snapshots on disk (default: 1, no deltas)')
 parser.add_argument('--video-path', help='file path to save video')
 parser.add_argument('--visdom-port', type=int, default=8097, help='visdom port')
+parser.add_argument('--no-visdom', action='store_true', default=False,
+                    help='only write metrics to --metrics-path, never to visdom')
+parser.add_argument('--metrics-path', help='JSONL file to append metric summaries to')
+parser.add_argument('--metrics-interval', type=float, default=10,
+                    help='seconds between metric flushes (default: 10)')
 args = parser.parse_args()
-
-
-def build_logger(build_state, checkpoint={}, run='NavA3C', port=8097):
-    vis = Visdom(port=port)
+if args.vtrace and (args.population_size > 1 or args.deterministic):
+    parser.error('--vtrace cannot be combined with --population-size or --deterministic')
+if args.deterministic and args.population_size > 1:
+    # PBT workers pick their members and updates on their own, outside the token order
+    parser.error('--deterministic cannot be combined with --population-size')
+if args.learner_batch_size < 1:
+    parser.error('--learner-batch-size must be at least 1')
+if args.checkpoint_format is None:
+    # Existing torch.save checkpoints keep their format
+    args.checkpoint_format = 'torch' if args.checkpoint_path and os.path.isfile(args.checkpoint_path) else 'flat'
+if args.checkpoint_path and args.checkpoint_format == 'flat' and os.path.isfile(args.checkpoint_path):
+    parser.error('--checkpoint-path {} is a torch.save file, flat checkpoints are directories'.format(
+        args.checkpoint_path))
+if args.checkpoint_path and args.checkpoint_format == 'torch' and os.path.isdir(args.checkpoint_path):
+    parser.error('--checkpoint-path {} is a flat checkpoint directory, not a torch.save file'.format(
+        args.checkpoint_path))
+if not 0 <= args.pbt_fraction <= 0.5:
+    # Above one half, a member could be both copied from and replaced in one step
+    parser.error('--pbt-fraction must be between 0 and 0.5')
+if min(args.map_staleness, args.map_exploration) < 0 or args.map_staleness + args.map_exploration > 1:
+    # They are mixture weights next to the learning progress distribution
+    parser.error('--map-staleness and --map-exploration must be non-negative and sum to at most 1')
+if args.map_temperature <= 0:
+    parser.error('--map-temperature must be positive')
+
+
+METRIC_PLOTS = dict(grad_norm=('scatter', 'gradient norm'),
+                    worker_private_memory=('scatter', 'worker private memory (MB)'),
+                    policy_lag=('scatter', 'V-trace policy lag (rollouts)'),
+                    total_reward_train=('line', 'train reward'),
+                    total_reward_test=('line', 'test reward'),
+                    train_time=('scatter', 'training wall time (per episode)'),
+                    test_time=('scatter', 'evaluation wall time (per episode)'))
+
+METRIC_BINS = dict(grad_norm=np.logspace(-2, 3, 11),
+                   policy_lag=np.logspace(0, 3, 7),
+                   total_reward_train=np.linspace(-20, 20, 21),
+                   total_reward_test=np.linspace(-20, 20, 21),
+                   train_time=np.logspace(-2, 2, 9),
+                   test_time=np.logspace(-1, 3, 9))
+
+
+def build_logger(build_state, metrics, checkpoint={}, run='NavA3C', port=8097):
+    vis = None
+    if not args.no_visdom:
+        from visdom import Visdom
+
+        vis = Visdom(port=port)
     env = run
-    wins = mp.Manager().dict()
     offset = checkpoint.setdefault('offset', -1) + 1
+    # Created on first use in the process that writes checkpoints
+    writer = []
 
-    if 'plots' in checkpoint:
-        wins = dict((name, id)
-                    for name, id in checkpoint['plots'].items()
-                    if vis.win_exists(id, env))
+    def _save_checkpoint():
+        if args.checkpoint_path is None:
+            return
 
-    def _save_checkpoint(step):
-        if step % args.save_interval != 0 or args.checkpoint_path is None:
+        state = build_state()
+        state['offset'] = offset
+
+        if args.checkpoint_format == 'flat':
+            if not writer:
+                writer.append(CheckpointWriter(args.checkpoint_path, args.checkpoint_half,
+                                               args.checkpoint_compress, args.checkpoint_full_interval))
+            writer[0].save(state)
             return
 
         checkpoint_path = os.path.abspath(args.checkpoint_path)
@@ -87,50 +203,13 @@ def build_logger(build_state, checkpoint={}, run='NavA3C', port=8097):
         if not os.path.exists(checkpoint_dir):
             os.makedirs(checkpoint_dir)
 
-        state = build_state()
-        state['plots'] = dict(wins)
-        state['offset'] = offset
         torch.save(state, args.checkpoint_path)
 
-    def _log_scatter(value, step, win_name, title, mode='train'):
+    def _log_metric(value, step, name, mode='train'):
         if mode == 'test':
             step += offset
-        elif step % args.log_interval != 0:
-            return
 
-        if not vis.check_connection():
-            return
-
-        if isinstance(value, torch.Tensor):
-            norm = value.numpy()
-        else:
-            norm = value
-
-        win_id = wins.setdefault(win_name)
-        if win_id is None:
-            wins[win_name] = vis.scatter(X=np.array([[step, norm]]), win=win_id, env=env,
-                                         opts=dict(title=title))
-        else:
-            vis.scatter(X=np.array([[step, norm]]), win=win_id, env=env, update='append')
-        vis.save([env])
-
-    def _log_reward(total_reward, step, mode):
-        if mode == 'train' and step % args.log_interval != 0:
-            return
-
-        if not vis.check_connection():
-            return
-
-        win_name = 'total_reward_{}'.format(mode)
-        win_id = wins.setdefault(win_name)
-        if win_id is None:
-            wins[win_name] = vis.line(np.array([0, 0]), win=win_id, env=env,
-                                      opts=dict(title='{} reward'.format(mode)))
-        else:
-            vis.line(Y=np.array([total_reward]), X=np.array([step]),
-                     win=win_id, env=env, update='append')
-
-        vis.save([env])
+        metrics.record(name, value, step)
 
     def _log_video(video, step):
         step += offset
@@ -144,45 +223,45 @@ def build_logger(build_state, checkpoint={}, run='NavA3C', port=8097):
         if not os.path.exists(video_dir):
             os.makedirs(video_dir)
 
+        import skvideo.io
+
         skvideo.io.vwrite(video_path, np.array(video))
 
-        if not vis.check_connection():
+        if vis is None or not vis.check_connection():
             return
 
-        win_name = 'last_test_episode'
-        win_id = wins.setdefault(win_name)
-        if win_id is None:
-            wins[win_name] = vis.video(videofile=video_path, win=win_id, env=env,
-                                       opts=dict(title='episode {}'.format(step)))
-        else:
-            vis.video(videofile=video_path, win=win_id, env=env,
-                      opts=dict(title='episode {}'.format(step)))
+        vis.video(videofile=video_path, win='last_test_episode', env=env,
+                  opts=dict(title='episode {}'.format(step)))
 
         vis.save([env])
 
     return dict(video=_log_video,
-                grad_norm=lambda n, s: _log_scatter(n, s, 'grad_norm', 'gradient norm'),
-                train_reward=lambda r, s: _log_reward(r, s, 'train'),
-                test_reward=lambda r, s: _log_reward(r, s, 'test'),
-                train_time=lambda n, s: _log_scatter(n, s, 'train_time', 'training wall time (per episode)', 'train'),
-                test_time=lambda n, s: _log_scatter(n, s, 'test_time', 'evaluation wall time (per episode)', 'test'),
+                grad_norm=lambda n, s: _log_metric(n, s, 'grad_norm'),
+                train_reward=lambda r, s: _log_metric(r, s, 'total_reward_train'),
+                test_reward=lambda r, s: _log_metric(r, s, 'total_reward_test', 'test'),
+                train_time=lambda n, s: _log_metric(n, s, 'train_time'),
+                test_time=lambda n, s: _log_metric(n, s, 'test_time', 'test'),
+                memory=lambda r, s: _log_metric(r['private'] / 2. ** 20, s, 'worker_private_memory'),
+                policy_lag=lambda n, s: _log_metric(n, s, 'policy_lag'),
                 checkpoint=_save_checkpoint)
 
 
 if __name__ == '__main__':
+    # Workers inherit the imported modules and shared state instead of re-importing them
+    mp.set_start_method('fork')
     os.environ['OMP_NUM_THREADS'] = '1'
     os.environ['MKL_NUM_THREADS'] = '1'
     os.environ['CUDA_VISIBLE_DEVICES'] = ""
 
     kill = mp.Event()
-    counter = mp.Value('i', 0)
-    steps = mp.Value('i', 0)
-    lock = mp.Lock()
+    # One slot per training worker, one holding the totals restored from a
+    # checkpoint and one for the V-trace learner
+    counters = StepCounters(('episodes', 'steps'), args.num_processes + 2)
 
     torch.set_num_threads(1)
     torch.manual_seed(args.seed)
-    env = create_vizdoom_env(args.config_path, args.train_scenario_path)
-    shared_model = ActorCritic(env.observation_space.spaces[0].shape[0], env.action_space)
+    observation_space, action_space = env_spaces(args)
+    shared_model = ActorCritic(observation_space.spaces[0].shape[0], action_space)
     shared_model.share_memory()
 
     if args.no_shared:
@@ -191,36 +270,117 @@ if __name__ == '__main__':
         optimizer = SharedAdam(shared_model.parameters(), lr=args.lr)
         optimizer.share_memory()
 
-    if args.checkpoint_path and os.path.isfile(args.checkpoint_path):
+    checkpoint = {}
+    if args.checkpoint_path and checkpoint_exists(args.checkpoint_path):
+        checkpoint = load_checkpoint(args.checkpoint_path)
+    elif args.checkpoint_path and os.path.isfile(args.checkpoint_path):
         checkpoint = torch.load(args.checkpoint_path)
-        counter.value = checkpoint['episodes']
+
+    if checkpoint:
+        # Checkpoints written before steps were saved restart the step budget
+        counters.add(args.num_processes, episodes=checkpoint['episodes'], steps=checkpoint.get('steps', 0))
+
+    population = None
+    if args.population_size > 1:
+        rng = np.random.RandomState(args.seed)
+        population = pbt.Population(args.population_size, observation_space.spaces[0].shape[0],
+                                    action_space, args, rng)
+        if checkpoint:
+            population.restore(checkpoint, rng)
+    elif checkpoint:
         shared_model.load_state_dict(checkpoint['model'])
         shared_model.share_memory()
-        optimizer.load_state_dict(checkpoint['optimizer'])
-        optimizer.share_memory()
-    else:
-        checkpoint = {}
+        if args.no_shared:
+            # Each worker updates its own copy of the loaded moments
+            optimizer.load_state_dict(checkpoint['optimizer'])
+        else:
+            # The loaded moments may be private views on a memory-mapped
+            # checkpoint, so they are copied into the shared ones
+            optimizer.load_shared_state(checkpoint['optimizer'])
+
+    def build_state():
+        if population is None:
+            return dict(episodes=counters.total('episodes'),
+                        steps=counters.total('steps'),
+                        model=shared_model.state_dict(),
+                        optimizer=optimizer.state_dict())
+
+        best = population.best()
+        return dict(episodes=counters.total('episodes'),
+                    steps=counters.total('steps'),
+                    model=population.models[best].state_dict(),
+                    optimizer=population.optimizers[best].state_dict(),
+                    hyperparams=dict(zip(pbt.HYPERPARAMS, population.hyperparams[best].tolist())))
 
     processes = []
 
-    logging = build_logger(lambda: dict(episodes=counter.value,
-                                        model=shared_model.state_dict(),
-                                        optimizer=optimizer.state_dict()),
+    metrics = MetricsStore(METRIC_PLOTS.keys(), args.num_processes + 2, METRIC_BINS)
+    stop_metrics = mp.Event()
+    collector = mp.Process(target=collect, args=(metrics, args.metrics_path, args.metrics_interval, stop_metrics,
+                                                 None if args.no_visdom else args.visdom_port, args.run,
+                                                 METRIC_PLOTS))
+    collector.start()
+
+    logging = build_logger(build_state,
+                           metrics,
                            checkpoint,
                            args.run,
                            args.visdom_port)
 
-    p = mp.Process(target=test, args=(args.num_processes, args, shared_model, (counter, steps), logging, kill))
-    p.start()
-    processes.append(p)
+    if not args.synthetic_env:
+        # Workers fork with the engine bindings already imported
+        preload_modules()
 
-    for rank in range(0, args.num_processes):
-        p = mp.Process(target=train, args=(rank, args, shared_model, (counter, steps), lock, optimizer, logging, kill))
+    if args.lean_workers and not args.synthetic_env:
+        load_map_geometry(args.train_scenario_path)
+        load_map_geometry(args.test_scenario_path)
+        # Stop the garbage collector from touching, and so copying, objects inherited by the workers
+        gc.freeze()
+
+    scheduler = TokenScheduler(args.num_processes) if args.deterministic else None
+
+    map_scheduler = None
+    if args.map_priority and not args.synthetic_env:
+        map_scheduler = MapScheduler(sorted(load_map_geometry(args.train_scenario_path).keys()),
+                                     args.map_staleness, args.map_exploration, args.map_temperature)
+
+    if population is None:
+        p = mp.Process(target=test, args=(args.num_processes, args, shared_model, counters, logging, kill))
+        p.start()
+        processes.append(p)
+
+    if args.vtrace:
+        rollouts = mp.Queue(args.rollout_queue_size)
+        p = mp.Process(target=vtrace.learn, args=(args.num_processes + 1, args, shared_model, counters, optimizer,
+                                                  rollouts, logging, kill))
         p.start()
         processes.append(p)
 
+        for rank in range(0, args.num_processes):
+            p = mp.Process(target=vtrace.act, args=(rank, args, shared_model, counters, rollouts, logging, kill,
+                                                    map_scheduler))
+            p.start()
+            processes.append(p)
+    elif population is None:
+        for rank in range(0, args.num_processes):
+            p = mp.Process(target=train, args=(rank, args, shared_model, counters, optimizer, logging, kill,
+                                               scheduler, map_scheduler))
+            p.start()
+            processes.append(p)
+    else:
+        # Members are ranked by their training reward, so there is no separate evaluation worker
+        for rank in range(0, args.num_processes):
+            p = mp.Process(target=pbt.train, args=(rank, args, population, counters, logging, kill, map_scheduler))
+            p.start()
+            processes.append(p)
+
+        pbt.control(args, population, processes, logging, kill)
+
     for p in processes:
         p.join()
 
+    stop_metrics.set()
+    collector.join()
+
     if kill.is_set():
         raise Exception('bad exit')
@@ -0,0 +1,103 @@
+import os
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+
+def process_memory(pid='self'):
+    """Returns resident, private and shared memory in bytes of a process.
+
+    Private memory is what the process would free on exit; pages still
+    shared copy-on-write with the parent count as shared.
+    """
+    usage = dict(rss=0, private=0, shared=0)
+    try:
+        with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3 or fields[2] != 'kB':
+                    continue
+                key, value = fields[0].rstrip(':'), int(fields[1]) * 1024
+                if key == 'Rss':
+                    usage['rss'] = value
+                elif key in ('Private_Clean', 'Private_Dirty'):
+                    usage['private'] += value
+                elif key in ('Shared_Clean', 'Shared_Dirty'):
+                    usage['shared'] += value
+    except IOError:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            usage['rss'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return usage
+
+
+def tensor_bytes(tensors):
+    seen = set()
+    total = 0
+    for t in tensors:
+        if t is None:
+            continue
+        if isinstance(t, np.ndarray):
+            total += t.nbytes
+            continue
+        key = (t.untyped_storage().data_ptr(), t.untyped_storage().nbytes())
+        if key not in seen:
+            seen.add(key)
+            total += key[1]
+    return total
+
+
+def model_bytes(model):
+    return tensor_bytes([p for p in model.parameters()] +
+                        [p.grad for p in model.parameters()] +
+                        [b for b in model.buffers()])
+
+
+@contextmanager
+def saved_tensors(counter):
+    """Sums into ``counter['bytes']`` the storage autograd keeps for backward."""
+    seen = set()
+
+    def pack(t):
+        key = t.untyped_storage().data_ptr()
+        if key not in seen:
+            seen.add(key)
+            counter['bytes'] = counter.get('bytes', 0) + t.untyped_storage().nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        yield counter
+
+
+class MemoryReport(object):
+    """Per-worker breakdown of resident memory.
+
+    Components that own tensors are sized exactly with :meth:`add`; opaque
+    ones, like the ViZDoom engine, are sized by the change in resident
+    memory while they are created with :meth:`measure`.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.components = OrderedDict()
+
+    @contextmanager
+    def measure(self, component):
+        before = process_memory()['rss']
+        yield
+        self.components[component] = max(process_memory()['rss'] - before, 0)
+
+    def add(self, component, nbytes):
+        self.components[component] = nbytes
+
+    def as_dict(self):
+        report = OrderedDict(worker=self.name)
+        report.update(process_memory())
+        report.update(self.components)
+        return report
+
+    def __str__(self):
+        return '{} memory: {}'.format(self.name, ', '.join(
+            '{} {:.1f}MB'.format(key, value / 2. ** 20)
+            for key, value in self.as_dict().items() if key != 'worker'))
@@ -0,0 +1,202 @@
+import json
+import os
+import time
+
+import numpy as np
+import torch.multiprocessing as mp
+
+# Per (slot, metric) accumulator layout, followed by the histogram bins.
+# MIN and MAX cover the collector interval recorded in INTERVAL.
+COUNT, SUM, LAST, STEP, MIN, MAX, INTERVAL = range(7)
+NUM_FIELDS = 7
+
+
+class MetricsStore(object):
+    """Lock-free per-process metric accumulators in shared memory.
+
+    Every process that records gets its own slot, so each row has a single
+    writer and recording never takes a lock or leaves the process. Readers
+    (the collector) may see a slot mid-update, which only skews one interval.
+
+    Arguments:
+        names (list): metric names
+        num_slots (int): maximum number of recording processes
+        bins (dict, optional): metric name to histogram bin edges; values are
+            counted into ``len(edges) + 1`` bins including under/overflow
+    """
+
+    def __init__(self, names, num_slots, bins=None):
+        self.names = list(names)
+        self.index = dict((name, idx) for idx, name in enumerate(self.names))
+        self.bins = dict((name, np.asarray(edges, dtype=np.float64))
+                         for name, edges in (bins or {}).items())
+        self.num_slots = num_slots
+        self.width = NUM_FIELDS + max([len(edges) + 1 for edges in self.bins.values()] + [0])
+
+        self._raw = mp.RawArray('d', num_slots * len(self.names) * self.width)
+        self._next_slot = mp.Value('i', 0)
+        self._interval = mp.Value('i', 0, lock=False)
+        self._pid = None
+        self._slot = None
+        self._attach()
+
+        self.data[:, :, MIN] = np.inf
+        self.data[:, :, MAX] = -np.inf
+
+    def _attach(self):
+        self.data = np.frombuffer(self._raw, dtype=np.float64).reshape(self.num_slots, len(self.names), self.width)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._attach()
+
+    def _row(self, name):
+        if self._pid != os.getpid():
+            with self._next_slot.get_lock():
+                slot = self._next_slot.value
+                self._next_slot.value += 1
+            if slot >= self.num_slots:
+                raise RuntimeError('MetricsStore has no free slot for process {}'.format(os.getpid()))
+            self._pid, self._slot = os.getpid(), slot
+        return self.data[self._slot, self.index[name]]
+
+    def record(self, name, value, step):
+        value = float(value)
+        row = self._row(name)
+        row[SUM] += value
+        row[LAST] = value
+        row[STEP] = step
+        # The first value of a new interval restarts the extremes; only the
+        # owning process writes them, so no lock is needed
+        interval = self._interval.value
+        if row[INTERVAL] != interval:
+            row[MIN] = np.inf
+            row[MAX] = -np.inf
+            row[INTERVAL] = interval
+        if value < row[MIN]:
+            row[MIN] = value
+        if value > row[MAX]:
+            row[MAX] = value
+        if name in self.bins:
+            row[NUM_FIELDS + np.searchsorted(self.bins[name], value)] += 1
+        # Count last, so a reader never sees a count without its value
+        row[COUNT] += 1
+
+    def snapshot(self):
+        """Copies all slots and starts a new interval.
+
+        Returns the copy and the number of the interval it closes.
+        """
+        interval = self._interval.value
+        data = self.data.copy()
+        self._interval.value = interval + 1
+        return data, interval
+
+
+def _summarize(store, current, previous, interval):
+    summaries = []
+    for name, idx in store.index.items():
+        rows, last_rows = current[:, idx], previous[:, idx]
+        count = rows[:, COUNT].sum() - last_rows[:, COUNT].sum()
+        if count <= 0:
+            continue
+
+        latest = rows[:, STEP].argmax()
+        # A value recorded while the interval was closed may have landed in
+        # the next interval's extremes; fall back to the last value then
+        current_rows = rows[(rows[:, INTERVAL] == interval) & (rows[:, COUNT] > last_rows[:, COUNT])]
+        summary = dict(metric=name,
+                       step=int(rows[latest, STEP]),
+                       count=int(count),
+                       mean=(rows[:, SUM].sum() - last_rows[:, SUM].sum()) / count,
+                       last=rows[latest, LAST],
+                       min=current_rows[:, MIN].min() if len(current_rows) else rows[latest, LAST],
+                       max=current_rows[:, MAX].max() if len(current_rows) else rows[latest, LAST])
+        if name in store.bins:
+            num_bins = len(store.bins[name]) + 1
+            hist = rows[:, NUM_FIELDS:NUM_FIELDS + num_bins] - last_rows[:, NUM_FIELDS:NUM_FIELDS + num_bins]
+            summary['hist'] = hist.sum(0).astype(np.int64).tolist()
+        summaries.append(summary)
+    return summaries
+
+
+class _VisdomSink(object):
+    def __init__(self, port, env, plots):
+        from visdom import Visdom
+
+        self.vis = Visdom(port=port)
+        self.env = env
+        self.plots = plots
+        self.created = set()
+
+    def write(self, summaries):
+        if not self.vis.check_connection():
+            return
+
+        for summary in summaries:
+            name = summary['metric']
+            kind, title = self.plots.get(name, ('scatter', name))
+            if name not in self.created and not self.vis.win_exists(name, self.env):
+                update = None
+            else:
+                update = 'append'
+
+            X = np.array([summary['step']])
+            Y = np.array([summary['mean']])
+            if kind == 'line':
+                self.vis.line(Y=Y, X=X, win=name, env=self.env, update=update, opts=dict(title=title))
+            else:
+                self.vis.scatter(X=np.stack((X, Y), axis=1), win=name, env=self.env, update=update,
+                                 opts=dict(title=title))
+            self.created.add(name)
+
+        self.vis.save([self.env])
+
+
+def collect(store, path, interval, stop, visdom_port=None, visdom_env='main', plots=None):
+    """Periodically flushes the per-interval summary of ``store``.
+
+    Each metric that was recorded during an interval is appended as one JSON
+    line to ``path`` and, when ``visdom_port`` is given and Visdom is
+    importable, as one batched point per window.
+    """
+    sink = None
+    if visdom_port is not None:
+        try:
+            sink = _VisdomSink(visdom_port, visdom_env, plots or {})
+        except ImportError:
+            print('visdom is not installed, metrics are only written to {}'.format(path))
+
+    if path is not None:
+        path = os.path.abspath(path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+    previous = np.zeros_like(store.data)
+    while True:
+        stopping = stop.wait(interval)
+
+        current, closed = store.snapshot()
+        summaries = _summarize(store, current, previous, closed)
+        previous = current
+
+        if summaries:
+            now = time.time()
+            if path is not None:
+                with open(path, 'a') as f:
+                    for summary in summaries:
+                        summary['time'] = now
+                        f.write(json.dumps(summary) + '\n')
+            if sink is not None:
+                try:
+                    sink.write(summaries)
+                except Exception as err:
+                    print(err)
+
+        if stopping:
+            return
@@ -28,8 +28,58 @@ def weights_init(m):
         m.bias.data.fill_(0)
 
 
+# Widths of the inputs concatenated in front of each LSTM cell
+LSTM1_INPUTS = (256, 1)
+LSTM2_INPUTS = (256, 64, 3, 3)
+
+
+def pack_lstm_cell(cell, sizes):
+    """Input-major copies of ``cell``'s weights and its summed bias.
+
+    The input weights are split into contiguous row blocks of ``sizes``, one
+    per input that the stock cell gets concatenated. At small batch sizes
+    the matrix-vector products are noticeably faster on this layout.
+    """
+    weight_ih = cell.weight_ih.detach().t().contiguous()
+    return (weight_ih.split(sizes, 0), cell.weight_hh.detach().t().contiguous(),
+            (cell.bias_ih + cell.bias_hh).detach())
+
+
+def fused_lstm_cell(inputs, hidden, packed, gates):
+    """LSTMCell step on the separate ``inputs`` of a packed cell.
+
+    The gate pre-activations are accumulated in the preallocated ``gates``
+    and the nonlinearities applied in place, so only the new hidden and
+    cell state are allocated. Gradients are not supported.
+    """
+    hx, cx = hidden
+    weights_ih, weight_hh, bias = packed
+    torch.addmm(bias, hx, weight_hh, out=gates)
+    for x, weight in zip(inputs, weights_ih):
+        gates.addmm_(x, weight)
+
+    ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+    ingate.sigmoid_()
+    forgetgate.sigmoid_()
+    cellgate.tanh_()
+    outgate.sigmoid_()
+
+    cy = torch.addcmul(forgetgate * cx, ingate, cellgate)
+    hy = outgate * cy.tanh()
+    return hy, cy
+
+
 class ActorCritic(torch.nn.Module):
-    def __init__(self, num_inputs, action_space):
+    """Conv encoder, stacked LSTMCell core and actor, critic and depth heads.
+
+    With ``fused_core`` the LSTM cells run on split, input-major weight
+    copies whenever no gradients are needed, e.g. in evaluation and acting
+    workers, which saves the per-step concatenations. The copies are
+    rebuilt when the parameters change in place; the state dict is the same
+    either way.
+    """
+
+    def __init__(self, num_inputs, action_space, fused_core=False):
         super(ActorCritic, self).__init__()
         self.conv1 = nn.Conv2d(num_inputs, 16, 8, stride=4, padding=1)
         self.conv2 = nn.Conv2d(16, 32, 4, stride=2, padding=1)
@@ -61,10 +111,45 @@ class ActorCritic(torch.nn.Module):
         self.lstm2.bias_ih.data.fill_(0)
         self.lstm2.bias_hh.data.fill_(0)
 
+        self.fused_core = fused_core
+        self._packed = {}
+        self._gates = {}
+
         self.train()
 
+    def _packed_cell(self, name, sizes):
+        cell = getattr(self, name)
+        # load_state_dict and optimizer steps modify parameters in place,
+        # which bumps their version counters
+        version = tuple((param.data_ptr(), param._version) for param in cell.parameters())
+        if name not in self._packed or self._packed[name][0] != version:
+            self._packed[name] = (version, pack_lstm_cell(cell, sizes))
+        return self._packed[name][1]
+
+    def _gate_buffers(self, batch_size):
+        if batch_size not in self._gates:
+            self._gates[batch_size] = (torch.empty(batch_size, 4 * self.lstm1.hidden_size),
+                                       torch.empty(batch_size, 4 * self.lstm2.hidden_size))
+        return self._gates[batch_size]
+
+    def core(self, f, reward, velocity, action, hidden):
+        (hx1, cx1), (hx2, cx2) = hidden
+        fused = (self.fused_core and not torch.is_grad_enabled() and
+                 not torch.is_autocast_enabled('cpu') and f.dtype == torch.float32)
+
+        if not fused:
+            hx1, cx1 = self.lstm1(torch.cat((f, reward), dim=1), (hx1, cx1))
+            hx2, cx2 = self.lstm2(torch.cat((f, hx1, velocity, action), dim=1), (hx2, cx2))
+            return (hx1, cx1), (hx2, cx2)
+
+        gates1, gates2 = self._gate_buffers(f.size(0))
+        hx1, cx1 = fused_lstm_cell((f, reward), (hx1, cx1), self._packed_cell('lstm1', LSTM1_INPUTS), gates1)
+        hx2, cx2 = fused_lstm_cell((f, hx1, velocity, action), (hx2, cx2),
+                                   self._packed_cell('lstm2', LSTM2_INPUTS), gates2)
+        return (hx1, cx1), (hx2, cx2)
+
     def forward(self, inputs):
-        inputs, ((hx1, cx1), (hx2, cx2)) = inputs
+        inputs, hidden = inputs
         observation, _, reward, velocity, action = inputs
         x = F.selu(self.conv1(observation))
         x = F.selu(self.conv2(x))
@@ -72,9 +157,7 @@ class ActorCritic(torch.nn.Module):
         x = F.selu(self.fc1(x))
         f = x
 
-        hx1, cx1 = self.lstm1(torch.cat((x, reward), dim=1), (hx1, cx1))
-        x = hx1
-        hx2, cx2 = self.lstm2(torch.cat((f, x, velocity, action), dim=1), (hx2, cx2))
+        (hx1, cx1), (hx2, cx2) = self.core(f, reward, velocity, action, hidden)
         x = hx2
 
         d_f = self.fc_d1_f(f)
@@ -49,9 +49,22 @@ class SharedAdam(Optimizer):
         for group in self.param_groups:
             for p in group['params']:
                 state = self.state[p]
-                state['step'] = torch.tensor(0.)
-                state['exp_avg'] = torch.zeros_like(p.data)
-                state['exp_avg_sq'] = torch.zeros_like(p.data)
+                state['step'] = torch.tensor(0.).share_memory_()
+                state['exp_avg'] = torch.zeros_like(p.data).share_memory_()
+                state['exp_avg_sq'] = torch.zeros_like(p.data).share_memory_()
+
+    def load_shared_state(self, state_dict):
+        """Copies the per-parameter state of ``state_dict`` into the shared
+        state tensors made by ``share_memory``.
+
+        ``load_state_dict`` would replace them with the tensors of
+        ``state_dict``, which workers forked later no longer share.
+        """
+        params = [p for group in self.param_groups for p in group['params']]
+        with torch.no_grad():
+            for idx, param in enumerate(params):
+                for key, value in state_dict['state'].get(idx, {}).items():
+                    self.state[param][key].copy_(torch.as_tensor(value))
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -13,6 +13,14 @@ parser.add_argument('--port', type=int, default=8097)
 parser.add_argument('--workers', type=int, default=16)
 
 
+def sample_hyperparams(rng=np.random):
+    return dict(lr=rng.uniform(np.power(10., -4), 5 * np.power(10., -4)),
+                entropy_coef=rng.uniform(np.power(10., -4), np.power(10., -3)),
+                num_steps=rng.choice([50, 75]),
+                conv_depth_loss_coef=rng.choice([1 / 3.0, 10, 33]),
+                lstm_depth_loss_coef=rng.choice([1, 10 / 3.0, 10]))
+
+
 def main(args):
     file_path = os.path.dirname(os.path.realpath(__file__))
     root_base = os.path.abspath(args.root_path)
@@ -25,15 +33,11 @@ def main(args):
     if os.path.isfile(checkpoint_dir) or os.path.isfile(video_dir):
         print('remove {} / {}'.format(checkpoint_dir, video_dir))
 
-    hyperparams = dict(lr=np.random.uniform(np.power(10., -4), 5 * np.power(10., -4)),
-                       entropy_coef=np.random.uniform(np.power(10., -4), np.power(10., -3)),
-                       config_path='{}/doomfiles/default.cfg'.format(file_path),
+    hyperparams = sample_hyperparams()
+    hyperparams.update(config_path='{}/doomfiles/default.cfg'.format(file_path),
                        train_scenario_path='{}/doomfiles/11.wad'.format(file_path),
                        test_scenario_path='{}/doomfiles/11.wad'.format(file_path),
                        max_grad_norm=100,
-                       num_steps=np.random.choice([50, 75]),
-                       conv_depth_loss_coef=np.random.choice([1 / 3.0, 10, 33]),
-                       lstm_depth_loss_coef=np.random.choice([1, 10 / 3.0, 10]),
                        save_interval=1000,
                        eval_interval=300,
                        log_interval=2000,
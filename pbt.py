@@ -0,0 +1,192 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from counters import IntervalTrigger
+from envs import create_env
+from model import ActorCritic
+from optim import SharedAdam
+from train import run_update
+
+# Hyperparameters that are perturbed when a member is replaced
+HYPERPARAMS = ('lr', 'entropy_coef', 'conv_depth_loss_coef', 'lstm_depth_loss_coef')
+
+
+class Population(object):
+    """Members trained side by side in one job.
+
+    Every member is a shared ActorCritic with its own SharedAdam. Their
+    hyperparameters, reward estimates and update counts live in shared
+    tensors, so exploit/explore steps made by the controller are seen by all
+    workers on their next update.
+
+    Arguments:
+        size (int): number of members
+        num_inputs (int): observation channels
+        action_space (gym.Space): env action space
+        args (argparse.Namespace): run arguments, supplying the initial
+            hyperparameters
+        rng (np.random.RandomState): draws the initial hyperparameter
+            perturbations
+        perturbations (tuple, optional): factors a copied hyperparameter is
+            multiplied with
+    """
+
+    def __init__(self, size, num_inputs, action_space, args, rng, perturbations=(0.8, 1.25)):
+        self.size = size
+        self.perturbations = perturbations
+        self.models = []
+        self.optimizers = []
+        for _ in range(size):
+            model = ActorCritic(num_inputs, action_space)
+            model.share_memory()
+            optimizer = SharedAdam(model.parameters(), lr=args.lr)
+            # Moments must be visible to the controller when members are copied
+            optimizer.share_memory()
+            self.models.append(model)
+            self.optimizers.append(optimizer)
+
+        base = [getattr(args, name) for name in HYPERPARAMS]
+        self.hyperparams = torch.tensor([base] * size, dtype=torch.float64)
+        # Member 0 keeps the command line values, the rest start perturbed
+        for idx in range(1, size):
+            self.hyperparams[idx] *= torch.from_numpy(rng.choice(perturbations, len(HYPERPARAMS)))
+        self.hyperparams.share_memory_()
+
+        self.scores = torch.zeros(size, dtype=torch.float64).share_memory_()
+        self.updates = torch.zeros(size, dtype=torch.int64).share_memory_()
+
+    def restore(self, state, rng):
+        """Starts every member from a checkpointed ``state`` of the best member.
+
+        Weights and optimizer moments are copied into the shared tensors in
+        place, so workers and the controller keep seeing them. With saved
+        hyperparameters, member 0 resumes with them and the rest start
+        perturbed around them.
+        """
+        for model, optimizer in zip(self.models, self.optimizers):
+            model.load_state_dict(state['model'])
+            if 'optimizer' in state:
+                optimizer.load_shared_state(state['optimizer'])
+
+        if 'hyperparams' in state:
+            base = torch.tensor([state['hyperparams'][name] for name in HYPERPARAMS], dtype=torch.float64)
+            self.hyperparams[0] = base
+            for idx in range(1, self.size):
+                self.hyperparams[idx] = base * torch.from_numpy(rng.choice(self.perturbations, len(HYPERPARAMS)))
+
+    def member_args(self, idx, args):
+        member_args = argparse.Namespace(**vars(args))
+        for name, value in zip(HYPERPARAMS, self.hyperparams[idx].tolist()):
+            setattr(member_args, name, value)
+        return member_args
+
+    def report(self, idx, reward_per_step, decay=0.95):
+        # Racy like the Hogwild updates themselves; a lost report only delays the estimate
+        if self.updates[idx] == 0:
+            self.scores[idx] = reward_per_step
+        else:
+            self.scores[idx] = decay * self.scores[idx] + (1 - decay) * reward_per_step
+        self.updates[idx] += 1
+
+    def best(self):
+        return int(self.scores.argmax())
+
+    def exploit_and_explore(self, rng, fraction=0.25, ready=20):
+        """Replaces the worst ``fraction`` of members by perturbed copies of the best.
+
+        Only members with at least ``ready`` updates since their last
+        replacement take part. Returns the list of (source, target) copies.
+        """
+        candidates = [idx for idx in range(self.size) if self.updates[idx] >= ready]
+        count = int(len(candidates) * fraction)
+        if count == 0:
+            return []
+
+        ranked = sorted(candidates, key=lambda idx: float(self.scores[idx]))
+        copies = list(zip(rng.choice(ranked[-count:], count), ranked[:count]))
+        for src, dst in copies:
+            with torch.no_grad():
+                for dst_param, src_param in zip(self.models[dst].parameters(), self.models[src].parameters()):
+                    dst_param.copy_(src_param)
+                for dst_param, src_param in zip(self.models[dst].parameters(), self.models[src].parameters()):
+                    dst_state = self.optimizers[dst].state[dst_param]
+                    for key, value in self.optimizers[src].state[src_param].items():
+                        dst_state[key].copy_(value)
+
+            self.hyperparams[dst] = self.hyperparams[src] * torch.from_numpy(
+                rng.choice(self.perturbations, len(HYPERPARAMS)))
+            self.scores[dst] = self.scores[src]
+            self.updates[dst] = 0
+
+        return copies
+
+
+def train(rank, args, population, counters, loggers, kill, map_scheduler=None):
+    """Env worker that trains the members of ``population`` in turn.
+
+    Each worker owns one env and one local model and rotates through the
+    members, so every member draws rollouts from the whole worker pool.
+    """
+    torch.manual_seed(args.seed + rank)
+
+    log_trigger = IntervalTrigger(counters, 'episodes', args.log_interval)
+
+    env = create_env(args, args.train_scenario_path, map_scheduler)
+    env.seed(args.seed + rank)
+
+    model = ActorCritic(env.observation_space.spaces[0].shape[0], env.action_space)
+
+    model.train()
+
+    state = env.reset()
+    iteration = 0
+    while not kill.is_set() and counters.approx('steps') <= args.max_episode_steps:
+        try:
+            episode_start_time = time.time()
+            member = (rank + iteration) % population.size
+            iteration += 1
+
+            member_args = population.member_args(member, args)
+            optimizer = population.optimizers[member]
+            for group in optimizer.param_groups:
+                group['lr'] = member_args.lr
+
+            state, episode_length, rewards, grad_norm = run_update(member_args, model, population.models[member],
+                                                                   optimizer, env, state)
+            population.report(member, sum(rewards) / float(episode_length))
+
+            counters.add(rank, episodes=1, steps=episode_length * 4)
+
+            if loggers is not None and log_trigger():
+                cv = counters.approx('episodes')
+                loggers['grad_norm'](grad_norm, cv)
+                loggers['train_reward'](sum(rewards), cv)
+                loggers['train_time'](time.time() - episode_start_time, cv)
+
+            time.sleep(0.1)
+        except Exception as err:
+            print(err)
+            kill.set()
+
+
+def control(args, population, processes, loggers, kill):
+    """Runs exploit/explore every ``args.pbt_interval`` seconds until the workers exit."""
+    rng = np.random.RandomState(args.seed)
+    while True:
+        # Wait in short slices, so a finished or killed run does not sit out the interval
+        deadline = time.time() + args.pbt_interval
+        while time.time() < deadline and any(p.is_alive() for p in processes) and not kill.is_set():
+            kill.wait(min(1., max(deadline - time.time(), 0.)))
+        if not any(p.is_alive() for p in processes) or kill.is_set():
+            return
+
+        for src, dst in population.exploit_and_explore(rng, args.pbt_fraction, args.pbt_ready):
+            print('PBT: member {} <- member {}, {}'.format(dst, src, ', '.join(
+                '{} {:.3g}'.format(name, value)
+                for name, value in zip(HYPERPARAMS, population.hyperparams[dst].tolist()))))
+
+        if loggers is not None:
+            loggers['checkpoint']()
@@ -0,0 +1,149 @@
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from paramgen import sample_hyperparams
+
+# Runs a random hyperparameter sweep on one node with successive halving:
+# all trials start together on disjoint cores, and at the end of every rung
+# only the best 1/eta by evaluation reward survive. Survivors are restarted
+# from their checkpoints with the freed cores split between them. Every
+# trial needs at least two cores, one for evaluation and one for training.
+#
+# Checkpoints carry the step counter, so --max-episode-steps in the
+# main.py arguments bounds a trial's steps over all rungs, including the
+# last one, which trains until main.py exits on its own.
+#
+#   python sweep.py /scratch/sweep --trials 9 --eta 3 --rung-minutes 60 -- --synthetic-env
+
+parser = argparse.ArgumentParser(description='A3C hyperparameter sweep')
+parser.add_argument('root_path')
+parser.add_argument('--trials', type=int, default=9, help='number of sampled configurations (default: 9)')
+parser.add_argument('--cores', type=int, default=len(os.sched_getaffinity(0)),
+                    help='cores to split between trials (default: all available)')
+parser.add_argument('--eta', type=int, default=3, help='keep the best 1/eta trials per rung (default: 3)')
+parser.add_argument('--rung-minutes', type=float, default=60,
+                    help='length of the first rung, later rungs are eta times longer (default: 60)')
+parser.add_argument('--score-window', type=int, default=5,
+                    help='number of latest test reward summaries averaged into a score (default: 5)')
+parser.add_argument('--seed', type=int, default=666, help='random seed for sampling (default: 666)')
+parser.add_argument('main_args', nargs=argparse.REMAINDER,
+                    help='extra arguments for main.py, after --')
+
+
+class Trial(object):
+    def __init__(self, name, root, hyperparams):
+        self.name = name
+        self.root = os.path.join(root, name)
+        self.hyperparams = hyperparams
+        self.process = None
+        self.cores = []
+        self.score = -math.inf
+
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+
+    @property
+    def metrics_path(self):
+        return os.path.join(self.root, 'metrics.jsonl')
+
+    def command(self, main_args):
+        file_path = os.path.dirname(os.path.realpath(__file__))
+        flags = dict(self.hyperparams,
+                     num_processes=max(len(self.cores) - 1, 1),
+                     checkpoint_path=os.path.join(self.root, 'checkpoint.ckpt'),
+                     metrics_path=self.metrics_path)
+        cmd = [sys.executable, os.path.join(file_path, 'main.py'), self.name, '--no-visdom']
+        cmd += ['--{}={}'.format(flag.replace('_', '-'), value) for flag, value in flags.items()]
+        return cmd + main_args
+
+    def start(self, cores, main_args):
+        self.cores = cores
+        with open(os.path.join(self.root, 'output.log'), 'a') as log:
+            self.process = subprocess.Popen(self.command(main_args), stdout=log, stderr=subprocess.STDOUT,
+                                            start_new_session=True,
+                                            preexec_fn=lambda: os.sched_setaffinity(0, cores))
+
+    def stop(self):
+        if self.running():
+            # main.py's workers are not daemonic, so stop the whole process group
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait()
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def update_score(self, window):
+        if not os.path.isfile(self.metrics_path):
+            return self.score
+        with open(self.metrics_path) as f:
+            rewards = [record['mean'] for record in map(json.loads, f)
+                       if record['metric'] == 'total_reward_test']
+        if rewards:
+            self.score = float(np.mean(rewards[-window:]))
+        return self.score
+
+
+def split_cores(cores, count):
+    return [cores[idx::count] for idx in range(count)]
+
+
+def record(path, trial, rung, status):
+    with open(path, 'a') as f:
+        f.write(json.dumps(dict(trial=trial.name, rung=rung, status=status, score=trial.score,
+                                cores=len(trial.cores), hyperparams=trial.hyperparams,
+                                time=time.time()), default=float) + '\n')
+
+
+def main(args):
+    root = os.path.abspath(args.root_path)
+    results_path = os.path.join(root, 'sweep.jsonl')
+    main_args = args.main_args[1:] if args.main_args[:1] == ['--'] else args.main_args
+
+    rng = np.random.RandomState(args.seed)
+    cores = sorted(os.sched_getaffinity(0))[:args.cores]
+    num_trials = min(args.trials, len(cores) // 2)
+    if num_trials < 1:
+        parser.error('a sweep needs at least 2 cores and 1 trial, got {} cores and {} trials'.format(
+            len(cores), args.trials))
+    trials = [Trial('trial{:02d}'.format(idx), root, sample_hyperparams(rng)) for idx in range(num_trials)]
+
+    rung = 0
+    alive = trials
+    while alive:
+        for trial, trial_cores in zip(alive, split_cores(cores, len(alive))):
+            trial.start(trial_cores, main_args)
+            record(results_path, trial, rung, 'started')
+
+        # The last trial standing trains until main.py exits on its own
+        deadline = time.time() + 60 * args.rung_minutes * args.eta ** rung if len(alive) > 1 else math.inf
+        while time.time() < deadline and any(trial.running() for trial in alive):
+            time.sleep(min(30, max(deadline - time.time(), 0)))
+
+        finished = len(alive) == 1 or not any(trial.running() for trial in alive)
+        for trial in alive:
+            trial.update_score(args.score_window)
+            trial.stop()
+
+        alive = sorted(alive, key=lambda t: t.score, reverse=True)
+        keep = 0 if finished else int(math.ceil(len(alive) / float(args.eta)))
+        for idx, trial in enumerate(alive):
+            status = 'finished' if finished else 'promoted' if idx < keep else 'stopped'
+            record(results_path, trial, rung, status)
+            print('rung {} {} score {:.3f} {}'.format(rung, trial.name, trial.score, status))
+
+        alive = alive[:keep]
+        rung += 1
+
+
+if __name__ == '__main__':
+    main(parser.parse_args())
@@ -6,26 +6,28 @@ import torch
 import torch.nn.functional as F
 from torch.autograd import Variable
 
-from envs import create_vizdoom_env, state_to_torch, trajectory_to_video
+import envs
+from envs import create_env, map_geometry_bytes, state_to_torch, trajectory_to_video
+from memory import MemoryReport, model_bytes, tensor_bytes
 from model import ActorCritic
 
 
-def video(wad, map, goal_loc, obs_history, pose_history):
-    traj_video = trajectory_to_video(wad, map, obs_history.shape[1],
+def video(scenario, map, goal_loc, obs_history, pose_history):
+    traj_video = trajectory_to_video(scenario, map, obs_history.shape[1],
                                      pose_history, goal_loc)
     video = np.append(obs_history, traj_video, axis=2)
     return video
 
 
-def test(rank, args, shared_model, counter, loggers, kill):
-    counter, steps = counter
-
+def test(rank, args, shared_model, counters, loggers, kill):
     torch.manual_seed(args.seed + rank)
 
-    env = create_vizdoom_env(args.config_path, args.test_scenario_path)
+    report = MemoryReport('test')
+    with report.measure('env'):
+        env = create_env(args, args.test_scenario_path)
     env.seed(args.seed + rank)
 
-    model = ActorCritic(env.observation_space.spaces[0].shape[0], env.action_space)
+    model = ActorCritic(env.observation_space.spaces[0].shape[0], env.action_space, args.fused_core)
 
     model.eval()
 
@@ -42,19 +44,21 @@ def test(rank, args, shared_model, counter, loggers, kill):
     episode_length = 0
     episode_counter = 0
 
+    # Only the latest max_video_frames observations and poses are buffered
     obs_index = 0
-    obs_history = []
-    pose_history = []
+    obs_history = None
+    pose_history = deque(maxlen=args.max_video_frames)
     goal_loc = env.goal()
 
     model.load_state_dict(shared_model.state_dict())
 
-    while not kill.is_set() and steps.value <= args.max_episode_steps:
+    while not kill.is_set() and counters.approx('steps') <= args.max_episode_steps:
         try:
             episode_start_time = time.time()
             episode_length += 1
 
-            value, logit, _, _, hidden = model((state_to_torch(state), hidden))
+            with torch.no_grad():
+                value, logit, _, _, hidden = model((state_to_torch(state), hidden))
             prob = F.softmax(logit)
             action = prob.max(1, keepdim=True)[1].data.numpy()
 
@@ -67,11 +71,10 @@ def test(rank, args, shared_model, counter, loggers, kill):
                 else:
                     obs_frame = (np.moveaxis(state[0], 0, -1) * 255).astype(np.uint8)
 
-                    if isinstance(obs_history, list):
-                        obs_history.append(obs_frame)
-                    else:
-                        obs_history[obs_index, :, :, :] = obs_frame
-                        obs_index += 1
+                    if obs_history is None:
+                        obs_history = np.zeros((args.max_video_frames,) + obs_frame.shape, dtype=np.uint8)
+                    obs_history[obs_index % len(obs_history), :, :, :] = obs_frame
+                    obs_index += 1
 
                     pose_history.append(env.pose())
 
@@ -81,26 +84,39 @@ def test(rank, args, shared_model, counter, loggers, kill):
             #     done = True
 
             if done:
-                if isinstance(obs_history, list):
-                    obs_history = np.array(obs_history)
-
                 if loggers:
-                    loggers['test_reward'](env.game.get_total_reward(), episode_counter)
-                    loggers['video'](video(env.wad, env.current_map, goal_loc, obs_history, pose_history),
-                                     episode_counter)
+                    loggers['test_reward'](env.episode_reward, episode_counter)
+                    if env.scenario is not None and obs_index > 0:
+                        split = obs_index % len(obs_history)
+                        if obs_index > len(obs_history):
+                            frames = np.concatenate((obs_history[split:], obs_history[:split]))
+                        else:
+                            frames = obs_history[:obs_index]
+                        loggers['video'](video(env.scenario, env.current_map, goal_loc, frames, list(pose_history)),
+                                         episode_counter)
                     loggers['test_time'](time.time() - episode_start_time, episode_counter)
 
+                episodes = counters.approx('episodes')
                 print("Time {}, num episodes {}, FPS {:.0f}, episode reward {}, episode length {}".format(
                     time.strftime("%Hh %Mm %Ss", time.gmtime(time.time() - start_time)),
-                    counter.value, counter.value / (time.time() - start_time),
+                    episodes, episodes / (time.time() - start_time),
                     reward_sum, episode_length))
+
+                if args.memory_report_interval > 0 and episode_counter % args.memory_report_interval == 0:
+                    report.add('model', model_bytes(model))
+                    report.add('episode_buffers', tensor_bytes([obs_history, envs.frames]))
+                    report.add('map_geometry', map_geometry_bytes())
+                    print(report)
+                    if loggers:
+                        loggers['memory'](report.as_dict(), episode_counter)
+
                 reward_sum = 0
                 episode_length = 0
                 actions.clear()
                 state = env.reset()
 
                 obs_index = 0
-                pose_history = []
+                pose_history.clear()
                 goal_loc = env.goal()
 
                 hidden = ((torch.zeros(1, 64), torch.zeros(1, 64)),
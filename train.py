@@ -1,8 +1,13 @@
 import time
+from contextlib import nullcontext
+
 import torch
 import torch.nn.functional as F
 
-from envs import create_vizdoom_env, state_to_torch
+from counters import IntervalTrigger
+from deterministic import append_trace, trace_record
+from envs import create_env, map_geometry_bytes, state_to_torch
+from memory import MemoryReport, model_bytes, saved_tensors
 from model import ActorCritic
 
 
@@ -14,114 +19,207 @@ def ensure_shared_grads(model, shared_model):
         shared_param._grad = param.grad
 
 
-def train(rank, args, shared_model, counter, lock, optimizer, loggers, kill):
-    counter, steps = counter
+def autocast(args):
+    # Parameters, gradients and optimizer moments stay fp32, only the
+    # forward/backward arithmetic runs in bfloat16
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=getattr(args, 'bf16', False))
 
-    torch.manual_seed(args.seed + rank)
 
-    env = create_vizdoom_env(args.config_path, args.train_scenario_path)
-    env.seed(args.seed + rank)
+def rollout_loss(args, model, env, state, actions=None):
+    """Collects up to ``args.num_steps`` transitions from ``env`` with ``model``.
 
-    model = ActorCritic(env.observation_space.spaces[0].shape[0], env.action_space)
+    Returns the A3C loss, the next state, the number of steps taken and the
+    rewards. Only the loss keeps the rollout tensors alive. The sampled
+    actions are appended to ``actions`` if it is given.
+    """
+    values = []
+    log_probs = []
+    rewards = []
+    entropies = []
+    real_depths = []
+    conv_depths = []
+    lstm_depths = []
 
-    model.train()
+    hidden = ((torch.zeros(1, 64), torch.zeros(1, 64)),
+              (torch.zeros(1, 256), torch.zeros(1, 256)))
 
-    state = env.reset()
     done = True
     episode_length = 0
-    while not kill.is_set() and steps.value <= args.max_episode_steps:
-        try:
-            # Sync with the shared model
-            episode_start_time = time.time()
-            model.load_state_dict(shared_model.state_dict())
+    for step in range(args.num_steps):
+        episode_length += 1
+        torch_state = state_to_torch(state)
+        with autocast(args):
+            value, logit, depth_f, depth_h, hidden = model((torch_state, hidden))
+        value, logit, depth_f, depth_h = value.float(), logit.float(), depth_f.float(), depth_h.float()
+        hidden = tuple((hx.float(), cx.float()) for hx, cx in hidden)
+
+        prob = F.softmax(logit)
+        log_prob = F.log_softmax(logit)
+        entropy = -(log_prob * prob).sum(1, keepdim=True)
+        entropies.append(entropy)
+
+        action = prob.multinomial(1).data
+        log_prob = log_prob.gather(1, action)
+
+        if actions is not None:
+            actions.append(int(action[0, 0]))
+
+        real_depths.append(torch_state[1])
+        conv_depths.append(depth_f)
+        lstm_depths.append(depth_h)
+
+        state, reward, done, _ = env.step(action.numpy(), steps=4)
+
+        if done:
+            state = env.reset()
+
+        values.append(value)
+        log_probs.append(log_prob)
+        rewards.append(reward)
+
+        if done:
+            break
+
+    R = torch.zeros(1, 1)
+    if not done:
+        with autocast(args):
+            value, _, _, _, _ = model((state_to_torch(state), hidden))
+        R = value.data.float()
+
+    values.append(R)
+    policy_loss = 0
+    value_loss = 0
+    conv_depth_loss = sum(F.binary_cross_entropy_with_logits(d, r)
+                          for d, r in zip(conv_depths, real_depths))
+    lstm_depth_loss = sum(F.binary_cross_entropy_with_logits(d, r)
+                          for d, r in zip(lstm_depths, real_depths))
+
+    gae = torch.zeros(1, 1)
+    for i in reversed(range(len(rewards))):
+        R = args.gamma * R + rewards[i]
+        advantage = R - values[i]
+        value_loss = value_loss + 0.5 * advantage.pow(2)
+
+        # Generalized Advantage Estimataion
+        delta_t = rewards[i] + args.gamma * values[i + 1].data - values[i].data
+        gae = gae * args.gamma * args.tau + delta_t
+        policy_loss = policy_loss - log_probs[i] * gae - args.entropy_coef * entropies[i]
+
+    final_loss = policy_loss
+    final_loss += args.value_loss_coef * value_loss
+    final_loss += args.conv_depth_loss_coef * conv_depth_loss
+    final_loss += args.lstm_depth_loss_coef * lstm_depth_loss
+
+    return final_loss, state, episode_length, rewards
+
 
-            values = []
-            log_probs = []
-            rewards = []
-            entropies = []
-            real_depths = []
-            conv_depths = []
-            lstm_depths = []
+def run_update(args, model, shared_model, optimizer, env, state, memory=None, trace=None):
+    """Syncs ``model`` with ``shared_model``, collects a rollout from ``env``
+    and applies one A3C update to ``shared_model``.
 
-            hidden = ((torch.zeros(1, 64), torch.zeros(1, 64)),
-                      (torch.zeros(1, 256), torch.zeros(1, 256)))
+    If ``memory`` is a dict, the bytes autograd saves for the backward pass
+    are added up in ``memory['bytes']``. If ``trace`` is a dict, the sampled
+    actions and the loss are stored in it.
 
-            for step in range(args.num_steps):
-                episode_length += 1
-                torch_state = state_to_torch(state)
-                value, logit, depth_f, depth_h, hidden = model((torch_state, hidden))
-                prob = F.softmax(logit)
-                log_prob = F.log_softmax(logit)
-                entropy = -(log_prob * prob).sum(1, keepdim=True)
-                entropies.append(entropy)
+    Returns the next state, the number of steps taken, the rewards and the
+    gradient norm.
+    """
+    model.load_state_dict(shared_model.state_dict())
 
-                action = prob.multinomial(1).data
-                log_prob = log_prob.gather(1, action)
+    actions = [] if trace is not None else None
+    with saved_tensors(memory) if memory is not None else nullcontext():
+        final_loss, state, episode_length, rewards = rollout_loss(args, model, env, state, actions)
 
-                real_depths.append(torch_state[1])
-                conv_depths.append(depth_f)
-                lstm_depths.append(depth_h)
+    if trace is not None:
+        trace.update(actions=actions, loss=final_loss.detach().item())
 
-                state, reward, done, _ = env.step(action.numpy(), steps=4)
+    grad_norm = apply_update(args, model, shared_model, optimizer, final_loss)
 
-                if done:
-                    state = env.reset()
+    return state, episode_length, rewards, grad_norm
 
-                values.append(value)
-                log_probs.append(log_prob)
-                rewards.append(reward)
 
-                if done:
+def apply_update(args, model, shared_model, optimizer, loss):
+    """Backpropagates ``loss`` through ``model``, hands the clipped gradients
+    to ``shared_model`` and steps ``optimizer``. ``model`` may be
+    ``shared_model`` itself.
+
+    Returns the gradient norm.
+    """
+    optimizer.zero_grad()
+
+    # bfloat16 has the exponent range of fp32, so a static scale is only
+    # needed if the gradients of small losses underflow in bfloat16
+    loss_scale = getattr(args, 'loss_scale', 1.)
+    (loss * loss_scale).backward()
+    if loss_scale != 1.:
+        for param in model.parameters():
+            if param.grad is not None:
+                param.grad.data.div_(loss_scale)
+
+    grad_norm = torch.nn.utils.clip_grad_norm(model.parameters(), args.max_grad_norm)
+    ensure_shared_grads(model, shared_model)
+    optimizer.step()
+
+    return grad_norm
+
+
+def train(rank, args, shared_model, counters, optimizer, loggers, kill, scheduler=None, map_scheduler=None):
+    torch.manual_seed(args.seed + rank)
+    if scheduler is not None:
+        torch.use_deterministic_algorithms(True, warn_only=True)
+
+    log_trigger = IntervalTrigger(counters, 'episodes', args.log_interval)
+    # A single process writes checkpoints
+    checkpoint_trigger = IntervalTrigger(counters, 'episodes', args.save_interval) if rank == 0 else None
+    memory_trigger = IntervalTrigger(counters, 'episodes', args.memory_report_interval) \
+        if args.memory_report_interval > 0 else None
+
+    report = MemoryReport('train{}'.format(rank))
+    with report.measure('env'):
+        env = create_env(args, args.train_scenario_path, map_scheduler)
+    env.seed(args.seed + rank)
+
+    model = ActorCritic(env.observation_space.spaces[0].shape[0], env.action_space)
+
+    model.train()
+
+    state = env.reset()
+    while not kill.is_set():
+        try:
+            episode_start_time = time.time()
+            memory = {} if memory_trigger is not None and memory_trigger() else None
+            trace = {} if args.trace_path is not None else None
+
+            with scheduler.turn(rank, kill) if scheduler is not None else nullcontext():
+                # Checked while holding the turn, so no worker leaves the rotation early
+                if counters.approx('steps') > args.max_episode_steps:
                     break
 
-            R = torch.zeros(1, 1)
-            if not done:
-                value, _, _, _, _ = model((state_to_torch(state), hidden))
-                R = value.data
-
-            values.append(R)
-            policy_loss = 0
-            value_loss = 0
-            conv_depth_loss = sum(F.binary_cross_entropy_with_logits(d, r)
-                                  for d, r in zip(conv_depths, real_depths))
-            lstm_depth_loss = sum(F.binary_cross_entropy_with_logits(d, r)
-                                  for d, r in zip(lstm_depths, real_depths))
-
-            gae = torch.zeros(1, 1)
-            for i in reversed(range(len(rewards))):
-                R = args.gamma * R + rewards[i]
-                advantage = R - values[i]
-                value_loss = value_loss + 0.5 * advantage.pow(2)
-
-                # Generalized Advantage Estimataion
-                delta_t = rewards[i] + args.gamma * values[i + 1].data - values[i].data
-                gae = gae * args.gamma * args.tau + delta_t
-                policy_loss = policy_loss - log_probs[i] * gae - args.entropy_coef * entropies[i]
-
-            optimizer.zero_grad()
-
-            final_loss = policy_loss
-            final_loss += args.value_loss_coef * value_loss
-            final_loss += args.conv_depth_loss_coef * conv_depth_loss
-            final_loss += args.lstm_depth_loss_coef * lstm_depth_loss
-            final_loss.backward()
-
-            grad_norm = torch.nn.utils.clip_grad_norm(model.parameters(), args.max_grad_norm)
-            ensure_shared_grads(model, shared_model)
-            optimizer.step()
-
-            with lock:
-                steps.value += episode_length * 4
-                counter.value += 1
-                episode_length = 0
-
-                cv = int(counter.value)
+                state, episode_length, rewards, grad_norm = run_update(args, model, shared_model, optimizer, env,
+                                                                       state, memory, trace)
+                counters.add(rank, episodes=1, steps=episode_length * 4)
+
+                if trace is not None:
+                    append_trace(args.trace_path, trace_record(counters.approx('episodes'), rank,
+                                                               trace['actions'], trace['loss']))
+
+            if memory is not None:
+                report.add('model', model_bytes(model))
+                report.add('shared_model', model_bytes(shared_model))
+                report.add('rollout', memory.get('bytes', 0))
+                report.add('map_geometry', map_geometry_bytes())
+                print(report)
+                if loggers is not None:
+                    loggers['memory'](report.as_dict(), counters.approx('episodes'))
 
             if loggers is not None:
-                loggers['checkpoint'](cv)
-                loggers['grad_norm'](grad_norm, cv)
-                loggers['train_reward'](sum(rewards), cv)
-                loggers['train_time'](time.time() - episode_start_time, cv)
+                if checkpoint_trigger is not None and checkpoint_trigger():
+                    loggers['checkpoint']()
+                if log_trigger():
+                    cv = counters.approx('episodes')
+                    loggers['grad_norm'](grad_norm, cv)
+                    loggers['train_reward'](sum(rewards), cv)
+                    loggers['train_time'](time.time() - episode_start_time, cv)
 
             time.sleep(0.1)
         except Exception as err:
@@ -0,0 +1,283 @@
+import queue
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from counters import IntervalTrigger
+from envs import create_env, state_to_torch
+from model import ActorCritic
+from train import apply_update, autocast
+
+
+def vtrace_targets(log_rhos, rewards, values, bootstrap, gamma, rho_bar=1., c_bar=1., masks=None):
+    """V-trace value targets and policy gradient advantages (Espeholt et al., 2018).
+
+    All arguments are tensors over the rollout steps, optionally followed by
+    a batch dimension, except ``bootstrap``, the value of the state after
+    the last step. ``log_rhos`` are the log importance weights
+    pi(a|x) / mu(a|x) of the taken actions. With on-policy data and
+    ``rho_bar``, ``c_bar`` >= 1 the targets are the n-step returns of the
+    rollout.
+
+    ``masks`` is 0 on the padding after a shorter rollout in a batch. The
+    padding ``values`` must hold that rollout's bootstrap value, which its
+    last step then bootstraps from.
+    """
+    if masks is not None:
+        log_rhos = log_rhos * masks
+    rhos = log_rhos.exp()
+    clipped_rhos = rhos.clamp(max=rho_bar)
+    cs = rhos.clamp(max=c_bar)
+
+    next_values = torch.cat((values[1:], bootstrap.unsqueeze(0)))
+    deltas = clipped_rhos * (rewards + gamma * next_values - values)
+    if masks is not None:
+        deltas = deltas * masks
+
+    vs_minus_v = torch.zeros_like(values)
+    acc = torch.zeros_like(bootstrap)
+    for t in reversed(range(len(values))):
+        acc = deltas[t] + gamma * cs[t] * acc
+        vs_minus_v[t] = acc
+    vs = values + vs_minus_v
+
+    next_vs = torch.cat((vs[1:], bootstrap.unsqueeze(0)))
+    pg_advantages = clipped_rhos * (rewards + gamma * next_vs - values)
+    if masks is not None:
+        pg_advantages = pg_advantages * masks
+    return vs, pg_advantages
+
+
+def collect_rollout(args, model, env, state):
+    """Acts in ``env`` with ``model`` for up to ``args.num_steps`` steps.
+
+    Returns the rollout as a dict of numpy arrays, the next state, the
+    number of steps taken and the rewards. The rollout holds ``steps + 1``
+    states, the last one only used for bootstrapping if the episode did not
+    end, and the behaviour policy logits of every step.
+    """
+    hidden = ((torch.zeros(1, 64), torch.zeros(1, 64)),
+              (torch.zeros(1, 256), torch.zeros(1, 256)))
+    initial_hidden = tuple((hx.numpy(), cx.numpy()) for hx, cx in hidden)
+
+    states = [state]
+    actions = []
+    logits = []
+    rewards = []
+
+    done = False
+    with torch.no_grad():
+        for step in range(args.num_steps):
+            with autocast(args):
+                _, logit, _, _, hidden = model((state_to_torch(state), hidden))
+            logit = logit.float()
+
+            action = F.softmax(logit, dim=1).multinomial(1)
+            state, reward, done, _ = env.step(action.numpy(), steps=4)
+            if done:
+                state = env.reset()
+
+            states.append(state)
+            actions.append(int(action[0, 0]))
+            logits.append(logit[0].numpy())
+            rewards.append(reward)
+
+            if done:
+                break
+
+    rollout = dict(states=tuple(np.stack(field) for field in zip(*states)),
+                   hidden=initial_hidden,
+                   actions=np.array(actions, dtype=np.int64),
+                   logits=np.stack(logits),
+                   rewards=np.array(rewards, dtype=np.float32),
+                   done=done)
+    return rollout, state, len(actions), rewards
+
+
+def _pad(array, length, mode='constant'):
+    return np.pad(array, [(0, length - len(array))] + [(0, 0)] * (array.ndim - 1), mode=mode)
+
+
+def vtrace_loss(args, model, rollouts):
+    """Replays ``rollouts`` through ``model`` as one batch from their initial
+    hidden states and returns the V-trace corrected loss with ``model`` as
+    the target policy, averaged over the rollouts.
+
+    Shorter rollouts are padded to the longest one by repeating their last
+    state; the padded steps are masked out of the targets and losses.
+    """
+    lengths = np.array([len(rollout['actions']) for rollout in rollouts])
+    num_steps = lengths.max()
+    batch_size = len(rollouts)
+
+    # The state after the last step of every rollout is kept for bootstrapping
+    states = tuple(torch.from_numpy(np.stack([_pad(field, num_steps + 1, 'edge') for field in fields], axis=1))
+                   for fields in zip(*(rollout['states'] for rollout in rollouts)))
+    hidden = tuple(tuple(torch.from_numpy(np.concatenate([rollout['hidden'][layer][idx] for rollout in rollouts]))
+                         for idx in range(2))
+                   for layer in range(2))
+
+    values = []
+    logits = []
+    conv_depths = []
+    lstm_depths = []
+    for t in range(num_steps + 1):
+        state = tuple(field[t] for field in states)
+        with autocast(args):
+            value, logit, depth_f, depth_h, hidden = model((state, hidden))
+        hidden = tuple((hx.float(), cx.float()) for hx, cx in hidden)
+        values.append(value.float().view(-1))
+        logits.append(logit.float())
+        conv_depths.append(depth_f.float())
+        lstm_depths.append(depth_h.float())
+
+    valid = torch.from_numpy(np.arange(num_steps + 1)[:, None] < lengths[None])
+    masks = valid[:-1].float()
+    values = torch.stack(values)
+    logits = torch.stack(logits[:-1])
+
+    done = torch.tensor([float(rollout['done']) for rollout in rollouts])
+    bootstrap = values.detach()[torch.from_numpy(lengths), torch.arange(batch_size)] * (1 - done)
+    target_values = torch.where(valid, values.detach(), bootstrap)
+
+    actions = torch.from_numpy(np.stack([_pad(rollout['actions'], num_steps) for rollout in rollouts], axis=1))
+    behaviour_logits = torch.from_numpy(np.stack([_pad(rollout['logits'], num_steps) for rollout in rollouts],
+                                                 axis=1))
+    rewards = torch.from_numpy(np.stack([_pad(rollout['rewards'], num_steps) for rollout in rollouts], axis=1))
+
+    log_probs = F.log_softmax(logits, dim=2)
+    entropies = -(log_probs * log_probs.exp()).sum(2)
+    log_probs = log_probs.gather(2, actions.unsqueeze(2)).squeeze(2)
+    behaviour_log_probs = F.log_softmax(behaviour_logits, dim=2).gather(2, actions.unsqueeze(2)).squeeze(2)
+
+    vs, pg_advantages = vtrace_targets(log_probs.detach() - behaviour_log_probs, rewards,
+                                       target_values[:-1], target_values[-1], args.gamma,
+                                       args.vtrace_rho_bar, args.vtrace_c_bar, masks)
+
+    policy_loss = -(log_probs * pg_advantages).sum() - args.entropy_coef * (entropies * masks).sum()
+    value_loss = 0.5 * ((vs - values[:-1]).pow(2) * masks).sum()
+    # Per step means over the depth bins, like the unbatched A3C loss
+    conv_depth_loss = sum((F.binary_cross_entropy_with_logits(d, states[1][t], reduction='none').mean(1) *
+                           masks[t]).sum() for t, d in enumerate(conv_depths[:-1]))
+    lstm_depth_loss = sum((F.binary_cross_entropy_with_logits(d, states[1][t], reduction='none').mean(1) *
+                           masks[t]).sum() for t, d in enumerate(lstm_depths[:-1]))
+
+    final_loss = policy_loss
+    final_loss += args.value_loss_coef * value_loss
+    final_loss += args.conv_depth_loss_coef * conv_depth_loss
+    final_loss += args.lstm_depth_loss_coef * lstm_depth_loss
+    return final_loss / batch_size
+
+
+def _put(rollouts, item, kill):
+    while not kill.is_set():
+        try:
+            rollouts.put(item, timeout=1.)
+            return
+        except queue.Full:
+            pass
+
+
+def act(rank, args, shared_model, counters, rollouts, loggers, kill, map_scheduler=None):
+    """Actor worker: acts with a local copy of ``shared_model`` that is only
+    synced every ``args.actor_sync_interval`` rollouts and puts the rollouts
+    on the ``rollouts`` queue for the learner, followed by ``None`` when it
+    stops.
+    """
+    torch.manual_seed(args.seed + rank)
+
+    log_trigger = IntervalTrigger(counters, 'episodes', args.log_interval)
+
+    env = create_env(args, args.train_scenario_path, map_scheduler)
+    env.seed(args.seed + rank)
+
+    model = ActorCritic(env.observation_space.spaces[0].shape[0], env.action_space, args.fused_core)
+    model.eval()
+
+    state = env.reset()
+    num_rollouts = 0
+    while not kill.is_set():
+        try:
+            if counters.approx('steps') > args.max_episode_steps:
+                break
+
+            episode_start_time = time.time()
+            if num_rollouts % args.actor_sync_interval == 0:
+                model.load_state_dict(shared_model.state_dict())
+                version = counters.approx('episodes')
+
+            rollout, state, episode_length, rewards = collect_rollout(args, model, env, state)
+            rollout['version'] = version
+            num_rollouts += 1
+            counters.add(rank, steps=episode_length * 4)
+
+            _put(rollouts, rollout, kill)
+
+            if loggers is not None and log_trigger():
+                cv = counters.approx('episodes')
+                loggers['train_reward'](sum(rewards), cv)
+                loggers['train_time'](time.time() - episode_start_time, cv)
+        except Exception as err:
+            print(err)
+            kill.set()
+
+    # Tell the learner that every rollout of this actor is queued. Exiting
+    # then waits until it has read them, as a rollout cut off mid-write
+    # would block it for good; only a killed run must not wait
+    _put(rollouts, None, kill)
+    if kill.is_set():
+        rollouts.cancel_join_thread()
+
+
+def learn(slot, args, shared_model, counters, optimizer, rollouts, loggers, kill):
+    """Learner worker: applies one V-trace update to ``shared_model`` per
+    batch of up to ``args.learner_batch_size`` rollouts drained from the
+    ``rollouts`` queue, until every actor has stopped. It is the only process
+    writing to ``shared_model``, so gradients are computed on it directly.
+    """
+    torch.manual_seed(args.seed + slot)
+
+    log_trigger = IntervalTrigger(counters, 'episodes', args.log_interval)
+    # The learner owns the up to date optimizer state, so it writes the checkpoints
+    checkpoint_trigger = IntervalTrigger(counters, 'episodes', args.save_interval)
+
+    shared_model.train()
+    # Every actor puts None after its last rollout, so once all of them are
+    # read every rollout has been used
+    stopped = 0
+    while not kill.is_set() and stopped < args.num_processes:
+        try:
+            batch = []
+            try:
+                item = rollouts.get(timeout=1.)
+                # Take whatever else is queued, but never wait for a full batch
+                while True:
+                    if item is None:
+                        stopped += 1
+                    else:
+                        batch.append(item)
+                    if len(batch) == args.learner_batch_size:
+                        break
+                    item = rollouts.get_nowait()
+            except queue.Empty:
+                pass
+            if not batch:
+                continue
+
+            final_loss = vtrace_loss(args, shared_model, batch)
+            grad_norm = apply_update(args, shared_model, shared_model, optimizer, final_loss)
+            # Episodes keep counting rollouts, as for the A3C workers
+            counters.add(slot, episodes=len(batch))
+
+            if loggers is not None:
+                if checkpoint_trigger():
+                    loggers['checkpoint']()
+                if log_trigger():
+                    cv = counters.approx('episodes')
+                    loggers['grad_norm'](grad_norm, cv)
+                    loggers['policy_lag'](np.mean([cv - rollout['version'] for rollout in batch]), cv)
+        except Exception as err:
+            print(err)
+            kill.set()